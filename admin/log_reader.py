@@ -0,0 +1,63 @@
+# IMPORTS
+# Reads log files backwards from the end, so the cost of a page depends on the page size and not the file size
+import glob
+import os
+
+
+# Active log file followed by its rotated files, newest first. Rotated files are path.1, path.2, ... for size based
+# rotation and dated suffixes for time based rotation, so they are ordered by modification time
+def log_files(path):
+    rotated = sorted(glob.glob(glob.escape(path) + '.*'), key=os.path.getmtime, reverse=True)
+    return ([path] if os.path.exists(path) else []) + rotated
+
+
+# Returns up to count lines ending at byte offset end, newest first, and the offset the oldest returned line starts
+# at. The file is read backwards in blocks until enough lines have been seen
+def read_lines_before(log_file, end, count, block_size=8192):
+    blocks = []
+    newlines = 0
+    position = end
+    while position > 0 and newlines <= count:
+        size = min(block_size, position)
+        position -= size
+        log_file.seek(position)
+        block = log_file.read(size)
+        blocks.append(block)
+        newlines += block.count(b'\n')
+
+    lines = b''.join(reversed(blocks)).split(b'\n')
+    if lines[-1] == b'':
+        lines.pop()
+    # the first line is only complete if the start of the file was reached
+    first = max(len(lines) - count, 1 if position > 0 else 0)
+    start = position + sum(len(line) + 1 for line in lines[:first])
+    return [line.decode('utf-8', 'replace') for line in reversed(lines[first:])], start
+
+
+# Returns (up to count lines newest first, cursor of the next older page or None). The cursor is
+# (inode, byte offset) so it stays valid when the files are rotated between pages
+def read_page(path, count, cursor=None):
+    files = log_files(path)
+    inodes = [os.stat(name).st_ino for name in files]
+
+    index = 0
+    end = None
+    if cursor is not None:
+        inode, end = cursor
+        if inode not in inodes:
+            return [], None
+        index = inodes.index(inode)
+
+    lines = []
+    while index < len(files) and len(lines) < count:
+        with open(files[index], 'rb') as log_file:
+            if end is None:
+                end = log_file.seek(0, os.SEEK_END)
+            page, end = read_lines_before(log_file, end, count - len(lines))
+        lines += page
+        if end > 0 and len(lines) == count:
+            return lines, (inodes[index], end)
+        index += 1
+        end = None
+
+    return lines, (inodes[index], os.path.getsize(files[index])) if index < len(files) else None
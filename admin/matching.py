@@ -0,0 +1,54 @@
+# IMPORTS
+# Kept free of app/model imports so process pool workers can import it cheaply
+import rsa
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+if numpy is not None:
+    # number of set bits in every possible byte, used to popcount whole arrays of masks at once
+    BYTE_POPCOUNT = numpy.array([bin(byte).count('1') for byte in range(256)], dtype=numpy.uint8)
+
+
+# Splits one owner's draws into tasks of at most task_size draws
+def build_tasks(owner_id, private_key, draw_key, draws, task_size):
+    return [(owner_id, private_key, draw_key, draws[i:i + task_size])
+            for i in range(0, len(draws), task_size)]
+
+
+# 60-bit mask of a draw string with bit n - 1 set for each number n, so draws match whatever order the numbers
+# were entered in
+def number_mask(numbers):
+    mask = 0
+    for number in numbers.split():
+        mask |= 1 << (int(number) - 1)
+    return mask
+
+
+# Decrypts the draws of a task and returns (draw id, numbers, owner id, mask) for each draw
+def decrypt_draws(task):
+    owner_id, private_key, draw_key, draws = task
+    cipher = AESGCM(draw_key) if draw_key is not None else None
+
+    decrypted = []
+    for draw_id, ciphertext, envelope in draws:
+        if envelope:
+            # Envelope decryption with the owner's data key
+            numbers = cipher.decrypt(ciphertext[:12], ciphertext[12:], None).decode()
+        else:
+            # Asymmetric decryption
+            numbers = rsa.decrypt(ciphertext, private_key).decode()
+        decrypted.append((draw_id, numbers, owner_id, number_mask(numbers)))
+    return decrypted
+
+
+# Number of winning numbers in each draw mask, computed for the whole batch of masks at once
+def count_matches(masks, winning_mask):
+    if numpy is None:
+        return [(mask & winning_mask).bit_count() for mask in masks]
+
+    matched = numpy.array(masks, dtype=numpy.uint64) & numpy.uint64(winning_mask)
+    return BYTE_POPCOUNT[matched.view(numpy.uint8)].reshape(-1, 8).sum(axis=1).tolist()
@@ -0,0 +1,370 @@
+# IMPORTS
+import json
+import multiprocessing
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+from app import db, app
+from models import User, Draw, ArchivedDraw, RoundJob, numbers_digest, decrypt_numbers
+from admin.matching import build_tasks, decrypt_draws, number_mask, count_matches
+from round_results import materialize_round, results_cache
+import key_cache
+
+
+# Statuses of a round job that is over: its results are written and its round can be closed
+DONE_STATUSES = ('finished', 'abandoned')
+
+
+# Summary of one run of the round engine over a round job
+class RoundReport:
+    def __init__(self, job):
+        self.lottery_round = job.lottery_round
+        self.tier_counts = {tier: 0 for tier in app.config['PRIZE_TIERS']}
+        # counts from a previous, interrupted run of the job
+        self.tier_counts.update({int(tier): count for tier, count in json.loads(job.tier_counts).items()})
+        self.processed = 0
+        self.chunks = 0
+        self.elapsed = 0.0
+
+    # Draws processed per second over the whole round
+    @property
+    def draws_per_second(self):
+        if self.elapsed <= 0:
+            return float(self.processed)
+        return self.processed / self.elapsed
+
+
+# Streams unplayed user draws with ids in (last_id, max_id] in chunks ordered by id (keyset pagination so each
+# chunk is one indexed query). Ciphertext is only loaded when every draw of the chunk is going to be decrypted
+def iter_unplayed_chunks(chunk_size, with_numbers, last_id, max_id):
+    columns = [Draw.id, Draw.user_id, Draw.numbers_digest]
+    if with_numbers:
+        columns += [Draw.numbers, Draw.envelope]
+
+    while True:
+        chunk = (db.session.query(*columns)
+                 .filter_by(master_draw=False, been_played=False)
+                 .filter(Draw.id > last_id, Draw.id <= max_id)
+                 .order_by(Draw.id)
+                 .limit(chunk_size)
+                 .all())
+        if not chunk:
+            return
+        last_id = chunk[-1].id
+        yield chunk
+
+
+# Highest prize tier won with the given number of matches, 0 if the draw wins nothing
+def prize_tier(matches):
+    return max([tier for tier in app.config['PRIZE_TIERS'] if tier <= matches], default=0)
+
+
+# Loads the DER encoded private keys and wrapped data keys of the given users in one query
+def load_key_blobs(user_ids):
+    return {user.id: (user.private_key, user.draw_key) for user in
+            db.session.query(User.id, User.private_key, User.draw_key).filter(User.id.in_(user_ids))}
+
+
+# Decrypts one chunk of draws and scores the whole chunk against the winning mask in one vectorized pass, loading all
+# the owners of the chunk in a single query. Decryption is spread over the process pool when one is given and the
+# chunk is large enough to be worth it. Returns (draw id, numbers, owner id, email, prize tier) for each winner
+def match_chunk(chunk, winning_mask, pool=None):
+    draws_by_owner = defaultdict(list)
+    for draw in chunk:
+        draws_by_owner[draw.user_id].append((draw.id, draw.numbers, draw.envelope))
+
+    owners = (db.session.query(User.id, User.email, User.key_version, User.draw_key.isnot(None).label('has_draw_key'))
+              .filter(User.id.in_(draws_by_owner))
+              .all())
+    emails = {owner.id: owner.email for owner in owners}
+    keys = key_cache.owner_keys(owners, load_key_blobs)
+
+    tasks = []
+    for owner in owners:
+        private_key, draw_key = keys[owner.id]
+        tasks.extend(build_tasks(owner.id, private_key, draw_key, draws_by_owner[owner.id],
+                                 app.config['ROUND_WORKER_CHUNK_SIZE']))
+
+    if pool is not None and len(chunk) >= app.config['ROUND_PARALLEL_MIN_DRAWS']:
+        decrypted = pool.map(decrypt_draws, tasks)
+    else:
+        decrypted = map(decrypt_draws, tasks)
+    decrypted = [draw for task_draws in decrypted for draw in task_draws]
+
+    matches = count_matches([draw[3] for draw in decrypted], winning_mask)
+    winners = [(draw_id, numbers, owner_id, emails[owner_id], prize_tier(draw_matches))
+               for (draw_id, numbers, owner_id, mask), draw_matches in zip(decrypted, matches)
+               if prize_tier(draw_matches)]
+
+    # keep results in draw order regardless of how owners were grouped or which worker finished first
+    winners.sort()
+    return winners
+
+
+# Marks a whole chunk as played in the job's round with bulk UPDATEs. The job checkpoint is committed in the same
+# transaction, so an interrupted round resumes exactly after the last chunk it committed
+def apply_chunk(chunk, winners, job, report):
+    draw_ids = [draw.id for draw in chunk]
+
+    Draw.query.filter(Draw.id.in_(draw_ids)).update({Draw.been_played: True, Draw.lottery_round: job.lottery_round},
+                                                    synchronize_session=False)
+    if winners:
+        db.session.execute(db.update(Draw), [{'id': winner[0], 'matches_master': True, 'prize_tier': winner[4]}
+                                             for winner in winners])
+
+    job.last_draw_id = draw_ids[-1]
+    job.processed += len(chunk)
+    job.tier_counts = json.dumps(report.tier_counts)
+    job.updated_at = datetime.now()
+    db.session.commit()
+
+
+# Loads the ciphertext of the given draws for decryption
+def load_draws(query):
+    return query.with_entities(Draw.id, Draw.user_id, Draw.numbers, Draw.envelope).order_by(Draw.id).all()
+
+
+# Plays every unplayed user draw of a round job against the winning numbers, starting after the job's checkpoint
+def run_round(job, winning_numbers, chunk_size=None):
+    chunk_size = chunk_size or app.config['ROUND_CHUNK_SIZE']
+    report = RoundReport(job)
+    last_id, max_id = job.last_draw_id, job.max_draw_id
+    start = time.perf_counter()
+    winning_mask = number_mask(winning_numbers)
+
+    # when only the jackpot pays out, winners are found with the blind index and the other draws are never
+    # decrypted. Lower prize tiers need every draw decrypted to count its matches
+    jackpot_only = min(app.config['PRIZE_TIERS']) == 6
+
+    # parallel matching is opt-in, rounds run in-process unless workers are configured.
+    # The pool is only started once there are enough draws to decrypt, so small rounds never pay for it.
+    # Workers are spawned rather than forked: this thread runs beside the log listener, key pool and request threads,
+    # and a forked worker could inherit a lock one of them held and never get it back
+    workers = app.config['ROUND_WORKERS']
+    pool = None
+
+    def matcher(draws):
+        nonlocal pool
+        if pool is None and workers > 1 and len(draws) >= app.config['ROUND_PARALLEL_MIN_DRAWS']:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        return match_chunk(draws, winning_mask, pool)
+
+    try:
+        indexed_winners = {}
+        if jackpot_only:
+            # exact winners are found with one indexed lookup on the blind index, only those draws are decrypted
+            candidates = load_draws(Draw.query.filter_by(master_draw=False, been_played=False,
+                                                         numbers_digest=numbers_digest(winning_numbers))
+                                    .filter(Draw.id > last_id, Draw.id <= max_id))
+            indexed_winners = {winner[0]: winner for winner in matcher(candidates)}
+
+        for chunk in iter_unplayed_chunks(chunk_size, not jackpot_only, last_id, max_id):
+            if jackpot_only:
+                winners = [indexed_winners[draw.id] for draw in chunk if draw.id in indexed_winners]
+
+                # draws stored before the blind index was backfilled still have to be decrypted
+                legacy_ids = [draw.id for draw in chunk if draw.numbers_digest is None]
+                if legacy_ids:
+                    winners.extend(matcher(load_draws(Draw.query.filter(Draw.id.in_(legacy_ids)))))
+                    winners.sort()
+            else:
+                winners = matcher(chunk)
+
+            # count winners per prize tier
+            for winner in winners:
+                report.tier_counts[winner[4]] += 1
+
+            apply_chunk(chunk, winners, job, report)
+
+            report.processed += len(chunk)
+            report.chunks += 1
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    report.elapsed = time.perf_counter() - start
+    return report
+
+
+# Decrypted numbers of a master draw
+def master_numbers(master_draw_id):
+    master_draw = db.session.get(Draw, master_draw_id)
+    creator = db.session.get(User, master_draw.user_id)
+
+    # decrypt a detached copy so the plaintext is never written back to the database
+    db.session.expunge(master_draw)
+    master_draw.view_numbers(key_cache.private_key(creator), key_cache.envelope_draw_key(creator, [master_draw]))
+    return master_draw.numbers
+
+
+# Runs a round job to completion, or marks it failed so it can be resumed
+def run_job(job_id):
+    with app.app_context():
+        job = db.session.get(RoundJob, job_id)
+        try:
+            run_round(job, master_numbers(job.master_draw_id))
+            # the round's results are committed together with the finished status
+            materialize_round(job)
+            job.status = 'finished'
+            job.updated_at = datetime.now()
+            db.session.commit()
+        except Exception as error:
+            app.logger.exception('Lottery round job %s failed', job_id)
+            db.session.rollback()
+            job = db.session.get(RoundJob, job_id)
+            job.status = 'failed'
+            job.error = repr(error)
+            job.updated_at = datetime.now()
+            db.session.commit()
+            return
+
+        # cached results of the previous round are dropped at once in this process, other processes follow
+        # within RESULTS_VERSION_TTL seconds
+        results_cache.set_version(job.lottery_round)
+
+
+def start_job_thread(job_id):
+    threading.Thread(target=run_job, args=(job_id,), name='lottery-round-%s' % job_id, daemon=True).start()
+
+
+# Starts the round of an unplayed master draw in the background. Returns None if another request got there first:
+# only one request can flip the master draw to played, and only one job can exist per round
+def start_round(master_draw, admin_id):
+    claimed = (Draw.query.filter_by(id=master_draw.id, been_played=False)
+               .update({Draw.been_played: True}, synchronize_session=False))
+    if not claimed:
+        db.session.rollback()
+        return None
+
+    max_draw_id, total = (db.session.query(db.func.max(Draw.id), db.func.count(Draw.id))
+                          .filter_by(master_draw=False, been_played=False)
+                          .one())
+    job = RoundJob(lottery_round=master_draw.lottery_round, master_draw_id=master_draw.id, started_by=admin_id,
+                   max_draw_id=max_draw_id or 0, total=total)
+    db.session.add(job)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+
+    start_job_thread(job.id)
+    return job
+
+
+# True if a job is not finished and nothing is working on it: it failed, or its worker stopped checkpointing
+def job_is_stalled(job):
+    if job.status == 'failed':
+        return True
+    stale_after = timedelta(seconds=app.config['ROUND_JOB_STALE_SECONDS'])
+    return job.status == 'running' and job.updated_at < datetime.now() - stale_after
+
+
+# Resumes a stalled job from its checkpoint. The job is claimed with a conditional update on its last heartbeat,
+# so two admins resuming at the same time start only one worker
+def resume_round(job):
+    claimed = (RoundJob.query.filter_by(id=job.id, status=job.status, updated_at=job.updated_at)
+               .update({RoundJob.status: 'running', RoundJob.error: None, RoundJob.updated_at: datetime.now()},
+                       synchronize_session=False))
+    db.session.commit()
+    if claimed:
+        start_job_thread(job.id)
+    return bool(claimed)
+
+
+# Gives up on a stalled job that cannot finish, e.g. a missing key or a draw that will not decrypt. The draws played
+# so far keep their results and the rest wait for the next round, so the round can be closed. Claimed like a resume,
+# so a job resumed at the same time is never abandoned under its worker
+def abandon_job(job):
+    claimed = (RoundJob.query.filter_by(id=job.id, status=job.status, updated_at=job.updated_at)
+               .update({RoundJob.status: 'abandoned', RoundJob.updated_at: datetime.now()},
+                       synchronize_session=False))
+    if claimed:
+        materialize_round(job)
+    db.session.commit()
+    if claimed:
+        results_cache.set_version(job.lottery_round)
+    return bool(claimed)
+
+
+# Progress of a round job as a JSON serialisable dict
+def job_progress(job):
+    elapsed = (job.updated_at - job.started_at).total_seconds()
+    return {'lottery_round': job.lottery_round,
+            'status': job.status,
+            'processed': job.processed,
+            'total': job.total,
+            'last_draw_id': job.last_draw_id,
+            'tier_counts': json.loads(job.tier_counts),
+            'draws_per_second': job.processed / elapsed if elapsed > 0 else 0.0,
+            'error': job.error}
+
+
+# Winners of a round as (round, numbers, user id, email, prize tier), decrypting only the winning draws.
+# The round is read from the live draws table or, once it has been closed, from the archive
+def winning_results(lottery_round):
+    winning_draws = []
+    for model in (Draw, ArchivedDraw):
+        winning_draws += (db.session.query(model.id, model.user_id, model.numbers, model.envelope, model.prize_tier)
+                          .filter_by(master_draw=False, matches_master=True, lottery_round=lottery_round)
+                          .all())
+    tiers = {draw.id: draw.prize_tier for draw in winning_draws}
+
+    draws_by_owner = defaultdict(list)
+    for draw in winning_draws:
+        draws_by_owner[draw.user_id].append((draw.id, draw.numbers, draw.envelope))
+
+    owners = (db.session.query(User.id, User.email, User.key_version, User.draw_key.isnot(None).label('has_draw_key'))
+              .filter(User.id.in_(draws_by_owner))
+              .all())
+    emails = {owner.id: owner.email for owner in owners}
+    keys = key_cache.owner_keys(owners, load_key_blobs)
+
+    results = []
+    for owner in owners:
+        private_key, draw_key = keys[owner.id]
+        for draw_id, numbers, owner_id, mask in decrypt_draws((owner.id, private_key, draw_key,
+                                                               draws_by_owner[owner.id])):
+            results.append((draw_id, lottery_round, numbers, owner_id, emails[owner_id], tiers[draw_id]))
+
+    results.sort()
+    return [result[1:] for result in results]
+
+
+# ROUND ARCHIVE
+# Columns copied from the draws table to the archive
+ARCHIVE_COLUMNS = ('user_id', 'numbers', 'numbers_digest', 'been_played', 'matches_master', 'prize_tier',
+                   'master_draw', 'lottery_round', 'envelope')
+
+
+# Moves the played draws and the master draw of every round up to and including lottery_round from the draws table
+# to the archive, in one transaction. Returns the number of draws archived
+def close_rounds(lottery_round):
+    played = db.and_(Draw.been_played.is_(True), Draw.lottery_round > 0, Draw.lottery_round <= lottery_round)
+    draws = db.select(*[getattr(Draw, column) for column in ARCHIVE_COLUMNS]).where(played).order_by(Draw.id)
+    db.session.execute(db.insert(ArchivedDraw).from_select(ARCHIVE_COLUMNS, draws))
+    archived = db.session.execute(db.delete(Draw).where(played)).rowcount
+    db.session.commit()
+    return archived
+
+
+# Number of the next lottery round, one after the latest round in the draws table, the archive or the round jobs
+def next_round_number():
+    latest = max(db.session.query(db.func.max(Draw.lottery_round)).filter_by(master_draw=True).scalar() or 0,
+                 db.session.query(db.func.max(ArchivedDraw.lottery_round)).filter_by(master_draw=True).scalar() or 0,
+                 db.session.query(db.func.max(RoundJob.lottery_round)).scalar() or 0)
+    return latest + 1
+
+
+# Decrypted winning numbers of a closed round, or None if the round is not in the archive
+def archived_master_numbers(lottery_round):
+    master_draw = ArchivedDraw.query.filter_by(master_draw=True, lottery_round=lottery_round).first()
+    if master_draw is None:
+        return None
+    creator = db.session.get(User, master_draw.user_id)
+    return decrypt_numbers(master_draw.numbers, master_draw.envelope,
+                           key_cache.private_key(creator), key_cache.envelope_draw_key(creator, [master_draw]))
@@ -0,0 +1,64 @@
+# IMPORTS
+import string
+
+from app import db
+from models import User
+
+# columns shown by the user tables of the admin page, so key blobs and password hashes are never loaded
+LISTED_COLUMNS = (User.id, User.email, User.firstname, User.lastname, User.birthdate, User.postcode, User.phone,
+                  User.registered_on, User.current_login, User.current_login_ip, User.last_login, User.last_login_ip,
+                  User.total_logins)
+
+# ASCII capitals to their lower case letters
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+# Lower case of a value as SQLite's lower() gives it, which only folds ASCII letters
+def fold_case(value):
+    return value.translate(ASCII_LOWER)
+
+
+# columns that can be searched by prefix, as the indexed expression compared and the function turning a search
+# value into the form of that expression. Emails and surnames are searched whatever their case, postcodes are stored
+# in capitals
+SEARCH_COLUMNS = {'email': (db.func.lower(User.email), fold_case),
+                  'lastname': (db.func.lower(User.lastname), fold_case),
+                  'postcode': (User.postcode, str.upper)}
+
+
+# Smallest string greater than every string starting with prefix, so a prefix search is the index range
+# prefix <= value < upper bound instead of a LIKE that can not use the index
+def prefix_upper_bound(prefix):
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+# Users with role 'user' after the keyset cursor, ordered by id, or by the searched column then id when searching.
+# after is the id of the last user of the previous page, after_value that user's searched column
+def users_query(field=None, prefix='', after=0, after_value=None):
+    query = db.session.query(*LISTED_COLUMNS).filter(User.role == 'user')
+    if not (field in SEARCH_COLUMNS and prefix):
+        return query.filter(User.id > after).order_by(User.id)
+
+    column, normalise = SEARCH_COLUMNS[field]
+    prefix = normalise(prefix)
+    query = query.filter(column >= prefix, column < prefix_upper_bound(prefix))
+    if after_value is not None:
+        query = query.filter(db.tuple_(column, User.id) > db.tuple_(normalise(after_value), after))
+    return query.order_by(column, User.id)
+
+
+# Returns (page of users, whether there is a next page)
+def user_page(page_size, field=None, prefix='', after=0, after_value=None):
+    users = users_query(field, prefix, after, after_value).limit(page_size + 1).all()
+    return users[:page_size], len(users) > page_size
+
+
+# Cheap estimate of the number of users listed, as (count, exact). Without a search the highest id is used, read
+# from the end of the primary key. A search counts at most limit matches
+def approximate_count(field=None, prefix='', limit=1000):
+    if not (field in SEARCH_COLUMNS and prefix):
+        return db.session.query(db.func.max(User.id)).scalar() or 0, False
+
+    matches = users_query(field, prefix).with_entities(User.id).order_by(None).limit(limit + 1).subquery()
+    count = db.session.query(db.func.count()).select_from(matches).scalar()
+    return min(count, limit), count <= limit
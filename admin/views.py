@@ -1,14 +1,21 @@
 # IMPORTS
 import random
 
-import rsa
-from flask import Blueprint, render_template, flash, redirect, url_for, session
+from flask import Blueprint, render_template, flash, redirect, url_for, session, jsonify, request
 from flask_login import login_required, current_user
-from app import db, requires_roles
-from models import User, Draw, encrypt
+from app import db, app, requires_roles, security_log_stats
+from models import User, Draw, RoundJob, encrypt, new_draw_key
+from admin.rounds import start_round, resume_round, abandon_job, job_is_stalled, job_progress, winning_results, \
+    close_rounds, next_round_number, archived_master_numbers, DONE_STATUSES
+from admin.log_reader import read_page
+from round_results import round_summary, results_cache
+from admin.user_search import user_page, approximate_count, SEARCH_COLUMNS
+from security_events import search
+from rate_limit import login_limiter_stats
 from users.forms import RegisterForm
 from sqlalchemy.orm import make_transient
-import pickle
+import key_cache
+from key_pool import key_pool
 import secrets
 
 # CONFIG
@@ -31,16 +38,23 @@ def admin():
 def generate_winning_draw():
     # get current winning draw
     current_winning_draw = Draw.query.filter_by(master_draw=True).first()
-    lottery_round = 1
 
     # if a current winning draw exists
     if current_winning_draw:
-        # update lottery round by 1
-        lottery_round = current_winning_draw.lottery_round + 1
+        if current_winning_draw.been_played:
+            # a played round is closed: its draws and winning draw move to the archive once the round has finished
+            round_job = RoundJob.query.filter_by(lottery_round=current_winning_draw.lottery_round).first()
+            if round_job and round_job.status not in DONE_STATUSES:
+                flash("Round %s has not finished yet." % current_winning_draw.lottery_round)
+                return redirect(url_for('admin.admin'))
+            close_rounds(current_winning_draw.lottery_round)
+        else:
+            # delete current winning draw, it was never played so there is no history to keep
+            db.session.delete(current_winning_draw)
+            db.session.commit()
 
-        # delete current winning draw
-        db.session.delete(current_winning_draw)
-        db.session.commit()
+    # the next round follows the latest round, including closed rounds in the archive
+    lottery_round = next_round_number()
 
     # get new winning numbers for draw using cryptographically secure random numbers generation
     # Empty set created as set cannot contain duplicates
@@ -61,9 +75,9 @@ def generate_winning_draw():
     #                        lottery_round=lottery_round, draw_key=current_user.draw_pin)
 
     # Asymmetric encryption
-    crypto_key = pickle.loads(current_user.public_key)
+    crypto_key = key_cache.public_key(current_user)
     new_winning_draw = Draw(user_id=current_user.id, numbers=winning_numbers_string, master_draw=True,
-                            lottery_round=lottery_round, public_key=crypto_key)
+                            lottery_round=lottery_round, public_key=crypto_key, draw_key=new_draw_key(current_user))
 
     # add the new winning draw to the database
     db.session.add(new_winning_draw)
@@ -90,8 +104,8 @@ def view_winning_draw():
         # current_winning_draw.view_numbers(current_user.draw_pin)
 
         # Asymmetric decrypting
-        crypto_key = pickle.loads(current_user.private_key)
-        current_winning_draw.view_numbers(crypto_key)
+        crypto_key = key_cache.private_key(current_user)
+        current_winning_draw.view_numbers(crypto_key, key_cache.envelope_draw_key(current_user, [current_winning_draw]))
 
         # re-render admin page with current winning draw and lottery round
         return render_template('admin/admin.html', winning_draw=current_winning_draw,
@@ -102,85 +116,145 @@ def view_winning_draw():
     return redirect(url_for('admin.admin'))
 
 
-# view lottery results and winners
+# run the lottery round in the background
 @admin_blueprint.route('/run_lottery')
 @login_required
 @requires_roles('admin')
 def run_lottery():
+    # an unfinished round is resumed from its checkpoint rather than started again
+    round_job = RoundJob.query.filter(RoundJob.status.not_in(DONE_STATUSES)).order_by(RoundJob.id.desc()).first()
+    if round_job:
+        if job_is_stalled(round_job) and resume_round(round_job):
+            flash("Round %s resumed after draw %s." % (round_job.lottery_round, round_job.last_draw_id))
+        else:
+            flash("Round %s is already running." % round_job.lottery_round)
+        return render_template('admin/admin.html', round_job=round_job, name=current_user.firstname)
+
     # get current unplayed winning draw
     current_winning_draw = Draw.query.filter_by(master_draw=True, been_played=False).first()
 
     # if current unplayed winning draw exists
     if current_winning_draw:
 
-        # get all unplayed user draws
-        user_draws = Draw.query.filter_by(master_draw=False, been_played=False).all()
-
-        results = []
+        # check at least one unplayed user draw exists
+        user_draw = Draw.query.filter_by(master_draw=False, been_played=False).first()
 
         # if at least one unplayed user draw exists
-        if user_draws:
+        if user_draw:
+            # mark the winning draw as played and play all un-played user draws in a background job
+            round_job = start_round(current_winning_draw, current_user.id)
+            if round_job is None:
+                flash("Round %s has already been started." % current_winning_draw.lottery_round)
+                return redirect(url_for('admin.admin'))
 
-            # update current winning draw as played
-            current_winning_draw.been_played = True
+            flash("Round %s started." % round_job.lottery_round)
+            return render_template('admin/admin.html', round_job=round_job, name=current_user.firstname)
 
-            db.session.add(current_winning_draw)
-            db.session.commit()
+        flash("No user draws entered.")
+        return admin()
 
-            # Decrypting draw numbers for winning user
-            winning_draw_creator = User.query.filter_by(id=current_winning_draw.user_id).first()
-            make_transient(current_winning_draw)
-            # Symmetric decryption
-            # current_winning_draw.view_numbers(winning_draw_creator.draw_pin)
+    # if current un-played winning draw does not exist
+    flash("Current winning draw expired. Add new winning draw for next round.")
+    return redirect(url_for('admin.admin'))
 
-            # Asymmetric decryption
-            w_draw_crypto_key = pickle.loads(winning_draw_creator.private_key)
-            current_winning_draw.view_numbers(w_draw_crypto_key)
 
-            # for each un-played user draw
-            for draw in user_draws:
+# give up on a stalled round that keeps failing, keeping the results of the draws played so far
+@admin_blueprint.route('/abandon_round')
+@login_required
+@requires_roles('admin')
+def abandon_round():
+    round_job = RoundJob.query.filter(RoundJob.status.not_in(DONE_STATUSES)).order_by(RoundJob.id.desc()).first()
+    if not round_job:
+        flash("No lottery round to abandon.")
+    elif job_is_stalled(round_job) and abandon_job(round_job):
+        flash("Round %s abandoned after %s draws, add a new winning draw to close it." % (round_job.lottery_round,
+                                                                                         round_job.processed))
+    else:
+        flash("Round %s is still running." % round_job.lottery_round)
+    return redirect(url_for('admin.admin'))
 
-                # get the owning user (instance/object)
-                user = User.query.filter_by(id=draw.user_id).first()
 
-                # Symmetric decryption
-                # draw.view_numbers(user.draw_pin)
+# Decrypted winners of a round, kept in the results cache only so the plaintext numbers never reach the database
+def round_winners(lottery_round):
+    return results_cache.get(('winners', lottery_round), lambda: winning_results(lottery_round))
 
-                # Asymmetric decryption
-                crypto_key = pickle.loads(user.private_key)
-                draw.view_numbers(crypto_key)
 
-                # if user draw matches current un-played winning draw
-                if draw.numbers == current_winning_draw.numbers:
-                    # add details of winner to list of results
-                    results.append((current_winning_draw.lottery_round, draw.numbers, draw.user_id, user.email))
+# progress of the latest lottery round, polled by the admin page while a round runs
+@admin_blueprint.route('/round_progress')
+@login_required
+@requires_roles('admin')
+def round_progress():
+    round_job = RoundJob.query.order_by(RoundJob.id.desc()).first()
+    if not round_job:
+        return jsonify(status='none')
+    return jsonify(job_progress(round_job))
 
-                    # update draw as a winning draw (this will be used to highlight winning draws in the user's
-                    # lottery page)
-                    draw.matches_master = True
 
-                # update draw as played
-                draw.been_played = True
+# view lottery results and winners of the latest finished round
+@admin_blueprint.route('/round_results')
+@login_required
+@requires_roles('admin')
+def round_results():
+    round_job = RoundJob.query.filter(RoundJob.status.in_(DONE_STATUSES)).order_by(RoundJob.id.desc()).first()
+    if not round_job:
+        flash("No lottery round has finished yet.")
+        return redirect(url_for('admin.admin'))
 
-                # update draw with current lottery round
-                draw.lottery_round = current_winning_draw.lottery_round
+    results = round_winners(round_job.lottery_round)
+    progress = job_progress(round_job)
+    # rounds finished before results were materialized only have the job's counters
+    summary = round_summary(round_job.lottery_round) or {'total_draws': round_job.processed,
+                                                         'tier_counts': progress['tier_counts']}
+    flash("Round %s%s: %s draws played (%.0f draws/s)." % (round_job.lottery_round,
+                                                          ' (abandoned)' if round_job.status == 'abandoned' else '',
+                                                          summary['total_draws'], progress['draws_per_second']))
+    if len(results) == 0:
+        flash("No winners.")
 
-                # commit draw changes to DB
-                db.session.add(draw)
-                db.session.commit()
+    return render_template('admin/admin.html', results=results, tier_counts=summary['tier_counts'],
+                           name=current_user.firstname)
 
-            if len(results) == 0:
-                flash("No winners.")
 
-            return render_template('admin/admin.html', results=results,
-                                   name=current_user.firstname)
+# view the winning numbers and winners of a closed round from the archive
+@admin_blueprint.route('/round_archive')
+@login_required
+@requires_roles('admin')
+def round_archive():
+    lottery_round = request.args.get('lottery_round', type=int)
+    winning_numbers = archived_master_numbers(lottery_round) if lottery_round else None
+    if winning_numbers is None:
+        flash("Round %s is not in the archive." % (lottery_round or ''))
+        return redirect(url_for('admin.admin'))
 
-        flash("No user draws entered.")
-        return admin()
+    results = round_winners(lottery_round)
+    summary = round_summary(lottery_round)
+    if summary is not None:
+        tier_counts = summary['tier_counts']
+    else:
+        # rounds closed before results were materialized
+        tier_counts = {}
+        for result in results:
+            tier_counts[result[4]] = tier_counts.get(result[4], 0) + 1
+
+    flash("Round %s winning numbers: %s." % (lottery_round, winning_numbers))
+    if len(results) == 0:
+        flash("No winners.")
+
+    return render_template('admin/admin.html', results=results, tier_counts=tier_counts,
+                           name=current_user.firstname)
 
-    # if current un-played winning draw does not exist
-    flash("Current winning draw expired. Add new winning draw for next round.")
-    return redirect(url_for('admin.admin'))
+
+# in-process cache and pool statistics used to tune their sizes
+@admin_blueprint.route('/metrics')
+@login_required
+@requires_roles('admin')
+def metrics():
+    return jsonify(key_cache=key_cache.key_cache.stats(),
+                   key_pool=key_pool.stats(),
+                   security_log=security_log_stats(),
+                   results_cache=results_cache.stats(),
+                   fragment_cache=app.jinja_env.fragment_cache.stats(),
+                   login_limiter=login_limiter_stats())
 
 
 # view all registered users
@@ -188,22 +262,71 @@ def run_lottery():
 @login_required
 @requires_roles('admin')
 def view_all_users():
-    current_users = User.query.filter_by(role='user').all()
+    field = request.args.get('field')
+    if field not in SEARCH_COLUMNS:
+        field = None
+    prefix = request.args.get('prefix', '').strip()
+
+    # keyset cursor, the last user of the previous page
+    after = request.args.get('after', 0, type=int)
+    after_value = request.args.get('after_value') if field and prefix else None
+
+    current_users, more = user_page(app.config['USERS_PAGE_SIZE'], field, prefix, after, after_value)
+    user_count, exact = approximate_count(field, prefix, app.config['USER_COUNT_LIMIT'])
+
+    next_page = None
+    if more:
+        last = current_users[-1]
+        next_page = {'field': field or '', 'prefix': prefix, 'after': last.id,
+                     'after_value': getattr(last, field) if field and prefix else ''}
 
     return render_template('admin/admin.html', name=current_user.firstname,
-                           current_users=current_users)
+                           current_users=current_users, user_search={'field': field, 'prefix': prefix},
+                           user_count=user_count, user_count_exact=exact, users_next_page=next_page)
 
 
-# view last 10 log entries
+# view the latest log entries, or older entries before the cursor given by the previous page
 @admin_blueprint.route('/logs')
 @login_required
 @requires_roles('admin')
 def logs():
-    with open("lottery.log", "r") as f:
-        content = f.read().splitlines()[-10:]
-        content.reverse()
+    cursor = None
+    try:
+        # cursor of the form <inode>:<byte offset>
+        cursor = tuple(int(part) for part in request.args['before'].split(':', 1))
+    except (KeyError, ValueError):
+        pass
+    if cursor is not None and len(cursor) != 2:
+        cursor = None
+
+    content, older = read_page(app.config['LOG_FILE'], app.config['LOG_PAGE_SIZE'], cursor)
 
-    return render_template('admin/admin.html', logs=content, name=current_user.firstname)
+    return render_template('admin/admin.html', logs=content, name=current_user.firstname,
+                           logs_before='%d:%d' % older if older else None)
+
+
+# search the structured security events, newest first, continuing before the last event of the previous page
+@admin_blueprint.route('/security_events')
+@login_required
+@requires_roles('admin')
+def security_events():
+    form = {name: request.args.get(name, '').strip() for name in ('event', 'ip', 'user', 'since', 'until')}
+    filters = {'event': form['event'] or None,
+               'ip': form['ip'] or None,
+               # datetime-local inputs send 2024-01-31T12:00, events are stored as 2024-01-31 12:00:00
+               'since': form['since'].replace('T', ' '),
+               'until': form['until'].replace('T', ' ') + ':59' if form['until'] else ''}
+    # user is either a user id or an email address
+    if form['user'].isdigit():
+        filters['user_id'] = int(form['user'])
+    elif form['user']:
+        filters['email'] = form['user']
+
+    before = request.args.get('before', type=int)
+    events, older = search(app.config['SECURITY_EVENTS_DB'], filters, before, app.config['LOG_PAGE_SIZE'])
+
+    return render_template('admin/admin.html', name=current_user.firstname, security_events=events,
+                           event_filters=form, events_before=older)
 
 
 # register admin users
@@ -223,7 +346,7 @@ def register_admin():
             return render_template('users/register.html', form=form)
 
         # create a new admin user with the form data
-        public_key, private_key = rsa.newkeys(512)
+        public_key, private_key = key_pool.take()
         new_admin = User(email=form.email.data,
                          firstname=form.firstname.data,
                          lastname=form.lastname.data,
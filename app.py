@@ -4,10 +4,19 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_qrcode import QRcode
 from flask_login import LoginManager, current_user
 from flask_talisman import Talisman
+from sqlalchemy import event
 from functools import wraps
+import atexit
 import os
 import logging
+import queue
+import time
 from dotenv import load_dotenv
+from security_log import DroppingQueueHandler, BatchQueueListener, rotating_file_handler
+from security_events import SecurityEventHandler, security_event
+from fragment_cache import FragmentCacheExtension
+from sqlite_profile import sqlite_pragmas, engine_options, pragma_listener
+from static_assets import assets_blueprint, asset_build, asset_url, prebuilt_error_page
 
 # CONFIG
 load_dotenv()
@@ -18,10 +27,91 @@ app.config['RECAPTCHA_PRIVATE_KEY'] = os.getenv('RECAPTCHA_PRIVATE_KEY')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI')
 app.config['SQLALCHEMY_ECHO'] = os.getenv('SQLALCHEMY_ECHO') == 'True'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = os.getenv('SQLALCHEMY_TRACK_MODIFICATIONS') == 'True'
+# key for the blind index of draw numbers. Required and kept apart from SECRET_KEY: stored digests are only valid
+# for the key they were made with, so rotating the session key must not change it. Databases indexed before it was
+# required were indexed with SECRET_KEY, set DRAW_INDEX_KEY to that value
+app.config['DRAW_INDEX_KEY'] = os.getenv('DRAW_INDEX_KEY')
+if not app.config['DRAW_INDEX_KEY']:
+    raise RuntimeError('DRAW_INDEX_KEY is not set, it keys the blind index of draw numbers')
+# lifetime in seconds of the cached identity used by the user loader and role checks
+app.config['USER_CACHE_TTL'] = int(os.getenv('USER_CACHE_TTL', 30))
+# size and lifetime in seconds of the in-process cache of decoded RSA keys
+app.config['KEY_CACHE_SIZE'] = int(os.getenv('KEY_CACHE_SIZE', 1024))
+app.config['KEY_CACHE_TTL'] = int(os.getenv('KEY_CACHE_TTL', 300))
+# pre-generated RSA key pairs for registration: refill starts below the low watermark and stops at the high one
+app.config['KEY_POOL_LOW'] = int(os.getenv('KEY_POOL_LOW', 4))
+app.config['KEY_POOL_HIGH'] = int(os.getenv('KEY_POOL_HIGH', 16))
+# 'rsa' encrypts each draw with the owner's RSA key, 'envelope' with a symmetric data key wrapped by that RSA key
+app.config['DRAW_ENCRYPTION'] = os.getenv('DRAW_ENCRYPTION', 'rsa')
+# numbers a draw has to match to win a prize, 6 only pays out the jackpot
+app.config['PRIZE_TIERS'] = [int(tier) for tier in os.getenv('PRIZE_TIERS', '3,4,5,6').split(',')]
+# seconds without a checkpoint after which a running lottery round is considered abandoned and can be resumed
+app.config['ROUND_JOB_STALE_SECONDS'] = int(os.getenv('ROUND_JOB_STALE_SECONDS', 120))
+# number of user draws loaded, matched and committed together when running a lottery round
+app.config['ROUND_CHUNK_SIZE'] = int(os.getenv('ROUND_CHUNK_SIZE', 1000))
+# parallel draw matching: worker processes (0 or 1 = in-process), draws per worker task and the smallest chunk
+# worth sending to the pool
+app.config['ROUND_WORKERS'] = int(os.getenv('ROUND_WORKERS', 0))
+app.config['ROUND_WORKER_CHUNK_SIZE'] = int(os.getenv('ROUND_WORKER_CHUNK_SIZE', 100))
+app.config['ROUND_PARALLEL_MIN_DRAWS'] = int(os.getenv('ROUND_PARALLEL_MIN_DRAWS', 200))
+# security log file and the number of entries shown per page of the admin log viewer
+app.config['LOG_FILE'] = os.getenv('LOG_FILE', 'lottery.log')
+app.config['LOG_PAGE_SIZE'] = int(os.getenv('LOG_PAGE_SIZE', 10))
+# users per page of the admin user list, and the most matches counted for a user search
+app.config['USERS_PAGE_SIZE'] = int(os.getenv('USERS_PAGE_SIZE', 50))
+app.config['USER_COUNT_LIMIT'] = int(os.getenv('USER_COUNT_LIMIT', 1000))
+# draws per page of a user's playable draws and results
+app.config['DRAWS_PAGE_SIZE'] = int(os.getenv('DRAWS_PAGE_SIZE', 20))
+# most draws a user can submit in one bulk submission
+app.config['MAX_BULK_TICKETS'] = int(os.getenv('MAX_BULK_TICKETS', 100))
+# size of the in-process cache of round results, and how often in seconds each process checks for a new round
+app.config['RESULTS_CACHE_SIZE'] = int(os.getenv('RESULTS_CACHE_SIZE', 10000))
+app.config['RESULTS_VERSION_TTL'] = int(os.getenv('RESULTS_VERSION_TTL', 5))
+# security log rotation: 'size' rotates at LOG_MAX_BYTES (0 = never), 'time' every LOG_ROTATE_WHEN (e.g. 'midnight'),
+# keeping LOG_BACKUP_COUNT rotated files
+app.config['LOG_ROTATION'] = os.getenv('LOG_ROTATION', 'size')
+app.config['LOG_MAX_BYTES'] = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+app.config['LOG_ROTATE_WHEN'] = os.getenv('LOG_ROTATE_WHEN', 'midnight')
+app.config['LOG_BACKUP_COUNT'] = int(os.getenv('LOG_BACKUP_COUNT', 5))
+# security events waiting to be written before new ones are dropped, and the most written in one batch
+app.config['LOG_QUEUE_SIZE'] = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+app.config['LOG_BATCH_SIZE'] = int(os.getenv('LOG_BATCH_SIZE', 100))
+# SQLite file of structured security events
+app.config['SECURITY_EVENTS_DB'] = os.getenv('SECURITY_EVENTS_DB',
+                                             os.path.join(app.instance_path, 'security_events.db'))
+
+# login attempts allowed per minute and in a burst, per client ip address and per email, and the most buckets
+# kept by each limiter
+app.config['LOGIN_IP_RATE'] = float(os.getenv('LOGIN_IP_RATE', 10))
+app.config['LOGIN_IP_BURST'] = int(os.getenv('LOGIN_IP_BURST', 20))
+app.config['LOGIN_EMAIL_RATE'] = float(os.getenv('LOGIN_EMAIL_RATE', 3))
+app.config['LOGIN_EMAIL_BURST'] = int(os.getenv('LOGIN_EMAIL_BURST', 5))
+app.config['LOGIN_MAX_BUCKETS'] = int(os.getenv('LOGIN_MAX_BUCKETS', 100000))
+# cache of the static template fragments: set DEPLOY_ID per deploy (e.g. the release tag), fragments rendered by
+# an earlier deploy are dropped when it changes. LOCALES are the locales fragments are rendered for
+app.config['FRAGMENT_CACHE'] = os.getenv('FRAGMENT_CACHE', 'True') == 'True'
+app.config['DEPLOY_ID'] = os.getenv('DEPLOY_ID', str(int(time.time())))
+app.config['LOCALES'] = os.getenv('LOCALES', 'en').split(',')
+app.jinja_env.add_extension(FragmentCacheExtension)
+# output of build_static.py: fingerprinted, precompressed static files and error pages
+app.config['ASSET_BUILD_DIR'] = os.getenv('ASSET_BUILD_DIR', os.path.join(app.root_path, 'build'))
+
+# SQLite and connection pool settings: SQLITE_PROFILE selects 'production' (WAL, busy timeout, pooled connections)
+# or 'default', single settings are overridden by SQLITE_<PRAGMA> (e.g. SQLITE_BUSY_TIMEOUT) and SQLALCHEMY_<OPTION>
+# (e.g. SQLALCHEMY_POOL_SIZE)
+app.config['SQLITE_PROFILE'] = os.getenv('SQLITE_PROFILE', 'production')
+app.config['SQLITE_PRAGMAS'] = sqlite_pragmas(app.config['SQLITE_PROFILE'], os.environ)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLITE_PROFILE'],
+                                                         app.config['SQLALCHEMY_DATABASE_URI'], os.environ)
 
 # initialise database
 db = SQLAlchemy(app)
 
+# the pragmas are applied to every new connection of the SQLite engine
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', pragma_listener(app.config['SQLITE_PRAGMAS']))
+
 # defining custom content security policy
 csp = {
     'default-src': [
@@ -51,28 +141,47 @@ talisman = Talisman(app, content_security_policy=csp)
 
 
 # LOGGER
-# Define logger filter class
-class SecurityFilter(logging.Filter):
-    def filter(self, record):
-        return 'SECURITY' in record.getMessage()
-
+# Security events are logged to a dedicated logger. Its handler only queues the record, the listener thread writes
+# queued records to the log file in batches
+security_logger = logging.getLogger('security')
+security_logger.setLevel(logging.INFO)
+security_logger.propagate = False
 
-# creating logger
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
+security_queue = queue.Queue(app.config['LOG_QUEUE_SIZE'])
+security_queue_handler = DroppingQueueHandler(security_queue)
+security_logger.addHandler(security_queue_handler)
 
 # file to append records to
-file_handler = logging.FileHandler('lottery.log', 'a')
-file_handler.setLevel(logging.WARNING)
-
-# Only writes to the log file message containing security string
-file_handler.addFilter(SecurityFilter())
+file_handler = rotating_file_handler(app.config['LOG_FILE'],
+                                     app.config['LOG_ROTATION'],
+                                     app.config['LOG_MAX_BYTES'],
+                                     app.config['LOG_BACKUP_COUNT'],
+                                     app.config['LOG_ROTATE_WHEN'])
 
 # Defining how log records are presented
 formatter = logging.Formatter('%(asctime)s : %(message)s', '%m/%d/%Y %I:%M:%S %p')
 file_handler.setFormatter(formatter)
 
-logger.addHandler(file_handler)
+# structured copy of the security events, searchable from the admin page
+os.makedirs(os.path.dirname(app.config['SECURITY_EVENTS_DB']) or '.', exist_ok=True)
+event_handler = SecurityEventHandler(app.config['SECURITY_EVENTS_DB'])
+
+security_listener = BatchQueueListener(security_queue, [file_handler, event_handler], app.config['LOG_BATCH_SIZE'])
+security_listener.start()
+# queued records are written out when the app exits
+atexit.register(security_listener.stop)
+
+
+# Counters of the security log pipeline
+def security_log_stats():
+    return {'queued': security_queue.qsize(),
+            'max_queued': security_queue.maxsize,
+            'dropped': security_queue_handler.dropped,
+            'written': security_listener.written,
+            'batches': security_listener.batches,
+            'handler_errors': security_listener.errors,
+            'events_failed': event_handler.failed,
+            'events_last_error': event_handler.last_error}
 
 
 # custom wrapper function for role access
@@ -81,11 +190,13 @@ def requires_roles(*roles):
         @wraps(f)
         def wrapped(*args, **kwargs):
             if current_user.role not in roles:
-                logging.warning('SECURITY - Forbidden Access [%s, %s, %s, %s]',
-                                current_user.id,
-                                current_user.email,
-                                current_user.role,
-                                request.remote_addr)
+                security_logger.warning('SECURITY - Forbidden Access [%s, %s, %s, %s]',
+                                        current_user.id,
+                                        current_user.email,
+                                        current_user.role,
+                                        request.remote_addr,
+                                        extra=security_event('forbidden', current_user.id, current_user.email,
+                                                             request.remote_addr))
                 return render_template('403.html')
             return f(*args, **kwargs)
 
@@ -102,6 +213,11 @@ login_manager.login_view = 'users.login'
 login_manager.init_app(app)
 
 
+# static files are linked by their fingerprinted names once build_static.py has been run
+asset_build.load(app.config['ASSET_BUILD_DIR'])
+app.jinja_env.globals['asset_url'] = asset_url
+
+
 # HOME PAGE VIEW
 @app.route('/')
 def index():
@@ -110,7 +226,7 @@ def index():
 
 # BLUEPRINTS
 # import blueprints
-from models import User
+from identity_cache import identity_cache
 from users.views import users_blueprint
 from admin.views import admin_blueprint
 from lottery.views import lottery_blueprint
@@ -119,37 +235,48 @@ from lottery.views import lottery_blueprint
 app.register_blueprint(users_blueprint)
 app.register_blueprint(admin_blueprint)
 app.register_blueprint(lottery_blueprint)
+app.register_blueprint(assets_blueprint)
+
+# key pairs are generated in the background from the server's first request, so the first registrations find the
+# pool filled while the scripts that only import the app (migrations, csv_db.py, build_static.py) never generate any
+from key_pool import key_pool
+
+
+@app.before_request
+def start_key_pool():
+    key_pool.start()
 
 
 @login_manager.user_loader
 def load_user(session_id):
-    return User.query.get(int(session_id))
+    return identity_cache.load(int(session_id))
 
 
 # ERROR HANDLERS
+# anonymous visitors get the error page prebuilt by build_static.py, if there is one
 @app.errorhandler(400)
 def bad_request(error):
-    return render_template('400.html'), 400
+    return prebuilt_error_page(400) or (render_template('400.html'), 400)
 
 
 @app.errorhandler(403)
 def forbidden_access(error):
-    return render_template('403.html'), 403
+    return prebuilt_error_page(403) or (render_template('403.html'), 403)
 
 
 @app.errorhandler(404)
 def not_found_error(error):
-    return render_template('404.html'), 404
+    return prebuilt_error_page(404) or (render_template('404.html'), 404)
 
 
 @app.errorhandler(500)
 def internal_error(error):
-    return render_template('500.html'), 500
+    return prebuilt_error_page(500) or (render_template('500.html'), 500)
 
 
 @app.errorhandler(503)
 def service_unavailable(error):
-    return render_template('503.html'), 503
+    return prebuilt_error_page(503) or (render_template('503.html'), 503)
 
 
 if __name__ == "__main__":
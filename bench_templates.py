@@ -0,0 +1,53 @@
+import argparse
+import timeit
+
+from flask import render_template
+from flask_login import login_user
+from app import app
+from identity_cache import CachedIdentity
+
+# Measures the rendering time of the main page templates with and without the fragment cache.
+#   python bench_templates.py                   5000 renders of each page
+#   python bench_templates.py --number 20000
+
+# (page, template, logged in role or None, template context)
+PAGES = [
+    ('index', 'main/index.html', None, {}),
+    ('index (user)', 'main/index.html', 'user', {}),
+    ('lottery', 'lottery/lottery.html', 'user', {'name': 'Bench'}),
+    ('admin', 'admin/admin.html', 'admin', {'name': 'Bench'}),
+    ('404', '404.html', None, {}),
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark page template rendering with the fragment cache.')
+    parser.add_argument('--number', type=int, default=5000, help='renders of each page per measurement')
+    parser.add_argument('--repeat', type=int, default=5, help='measurements per page, the fastest is reported')
+    return parser.parse_args()
+
+
+# Fastest time in microseconds of rendering a page once
+def render_time(template, role, context, fragment_cache, args):
+    app.config['FRAGMENT_CACHE'] = fragment_cache
+    with app.test_request_context('/', headers={'Accept-Language': 'en-GB,en;q=0.8'}):
+        if role is not None:
+            login_user(CachedIdentity((1, 'bench@email.com', 'Bench', role, 1)))
+        # first render compiles the template and fills the cache
+        render_template(template, **context)
+        timer = timeit.Timer(lambda: render_template(template, **context))
+        return min(timer.repeat(args.repeat, args.number)) / args.number * 1e6
+
+
+def main():
+    args = parse_args()
+    print('%-14s %10s %10s %10s' % ('page', 'full (us)', 'cached', 'saved'))
+    for name, template, role, context in PAGES:
+        full = render_time(template, role, context, False, args)
+        cached = render_time(template, role, context, True, args)
+        print('%-14s %10.1f %10.1f %9.0f%%' % (name, full, cached, (full - cached) / full * 100))
+    print('fragment cache:', app.jinja_env.fragment_cache.stats())
+
+
+if __name__ == '__main__':
+    main()
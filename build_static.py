@@ -0,0 +1,94 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+
+from flask import render_template
+from app import app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Builds the fingerprinted, precompressed static assets and error pages served by static_assets.py.
+#   python build_static.py                      build into ASSET_BUILD_DIR, keeping files of earlier builds
+#   python build_static.py --clean              remove earlier builds first
+# Every file in static/ is copied to <name>.<content hash>.<ext> with .gz and, if the brotli package is installed,
+# .br variants. manifest.json maps the original names to the fingerprinted ones and is written last, so a running
+# server only picks up a build once it is complete.
+
+# error pages rendered to static files, as seen by a visitor who is not logged in
+ERROR_PAGES = (400, 403, 404, 500, 503)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Build fingerprinted, precompressed static assets.')
+    parser.add_argument('--output-dir', default=app.config['ASSET_BUILD_DIR'], help='directory to build into')
+    parser.add_argument('--clean', action='store_true', help='remove files of earlier builds first')
+    return parser.parse_args()
+
+
+def fingerprinted_name(name, data):
+    root, extension = os.path.splitext(name)
+    return '%s.%s%s' % (root, hashlib.sha256(data).hexdigest()[:16], extension)
+
+
+# Writes data to path with its precompressed variants, each kept only if it is smaller than the original
+def write_variants(path, data):
+    variants = [('', data), ('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(data, quality=11)))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    for suffix, content in variants:
+        if suffix and len(content) >= len(data):
+            continue
+        with open(path + suffix, 'wb') as variant_file:
+            variant_file.write(content)
+
+
+def build_assets(output_dir):
+    assets = {}
+    for directory, _, files in os.walk(app.static_folder):
+        for file in sorted(files):
+            path = os.path.join(directory, file)
+            name = os.path.relpath(path, app.static_folder).replace(os.sep, '/')
+            with open(path, 'rb') as asset_file:
+                data = asset_file.read()
+            assets[name] = fingerprinted_name(name, data)
+            write_variants(os.path.join(output_dir, assets[name]), data)
+    return assets
+
+
+def build_error_pages(output_dir):
+    for code in ERROR_PAGES:
+        with app.test_request_context('/'):
+            page = render_template('%d.html' % code)
+        write_variants(os.path.join(output_dir, 'errors', '%d.html' % code), page.encode('utf-8'))
+    return list(ERROR_PAGES)
+
+
+def main():
+    args = parse_args()
+    if args.clean and os.path.exists(args.output_dir):
+        shutil.rmtree(args.output_dir)
+
+    manifest = {'assets': build_assets(args.output_dir),
+                'error_pages': build_error_pages(args.output_dir)}
+
+    manifest_path = os.path.join(args.output_dir, 'manifest.json')
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    for name, built in sorted(manifest['assets'].items()):
+        print('%s -> %s' % (name, built))
+    print('%d assets, %d error pages%s' % (len(manifest['assets']), len(manifest['error_pages']),
+                                           '' if brotli is not None else ' (no brotli, gzip only)'))
+
+
+if __name__ == '__main__':
+    main()
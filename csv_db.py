@@ -1,11 +1,154 @@
-# pip install pandas allows for the module to be used
-import pandas as pd
-import sqlite3
-
-# CSV file to read
-df = pd.read_csv('table.csv')
-# sqlite database uri to connect to i.e instance/db_name.db
-conn = sqlite3.connect('db_name.db')
-# turns the column entries into sql and inserts into database
-df.to_sql('Users', conn, if_exists='replace', index=False)
-conn.close()
+import argparse
+import ast
+import base64
+import csv
+import secrets
+import sys
+import time
+from datetime import datetime
+from itertools import islice
+
+import bcrypt
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from app import db, app
+from models import User, Draw
+
+# Loads a CSV file into the users or draws table of the app database, streaming the file in batches so memory use
+# does not depend on file size. CSV columns are matched to table columns by name, e.g. files written by to_csv.py
+#   python csv_db.py users.csv                          insert users
+#   python csv_db.py users.csv --upsert                 insert new users, update existing users with the same email
+#   python csv_db.py draws.csv --table draws            insert draws (numbers must already be encrypted)
+
+TABLES = {'users': User.__table__, 'draws': Draw.__table__}
+
+# string columns holding bytes (password hashes and encrypted draw numbers), written by to_csv.py as b'...'
+BYTES_STRING_COLUMNS = {User.__table__.c.password, Draw.__table__.c.numbers}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Bulk load a CSV file into the lottery database.')
+    parser.add_argument('file', help='CSV file to load')
+    parser.add_argument('--table', choices=list(TABLES), default='users', help='table to load the rows into')
+    parser.add_argument('--batch-size', type=int, default=5000, help='rows inserted per executemany call')
+    parser.add_argument('--transaction-size', type=int, default=100000, help='rows committed per transaction')
+    parser.add_argument('--upsert', action='store_true',
+                        help='users only, update the existing user with the same email instead of failing')
+    parser.add_argument('--hash-passwords', action='store_true',
+                        help='the password column holds plain text passwords to hash with bcrypt (slow)')
+    return parser.parse_args()
+
+
+# Yields the rows of a CSV file as lists of at most batch_size dicts
+def read_batches(path, batch_size):
+    with open(path, newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        while True:
+            batch = list(islice(reader, batch_size))
+            if not batch:
+                return
+            yield batch
+
+
+# Returns the function converting CSV values of a column to its python type, chosen once per column rather than
+# per value. Bytes are read back from the b'...' form to_csv.py writes, other text is loaded as it is
+def value_parser(column):
+    python_type = column.type.python_type
+    if python_type is bool:
+        parse = lambda value: value.lower() in ('true', '1')
+    elif python_type is int:
+        parse = int
+    elif python_type is datetime:
+        parse = datetime.fromisoformat
+    elif python_type is bytes:
+        parse = str.encode
+    else:
+        parse = str
+
+    holds_bytes = python_type is bytes or column in BYTES_STRING_COLUMNS
+
+    def parser(value):
+        if value == '' and column.nullable:
+            return None
+        if holds_bytes and value[:2] in ("b'", 'b"'):
+            return ast.literal_eval(value)
+        return parse(value)
+    return parser
+
+
+# Returns a function turning a CSV row into the insert parameters of table.
+# Columns missing from the file get the column default, set by the insert statement itself
+def row_converter(table, header, args):
+    # existing users keep their id when upserting, new users get the next one. The change counter of the exported
+    # database is not loaded, this database numbers the rows itself
+    parsers = [(name, value_parser(table.c[name])) for name in header
+               if name in table.c and name != 'change_seq' and not (args.upsert and name == 'id')]
+
+    missing = [column.name for column in table.c
+               if not column.nullable and not column.primary_key and column.default is None
+               and column.name not in header and column.name != 'registered_on']
+    if missing:
+        sys.exit('%s is missing required columns: %s' % (args.file, ', '.join(missing)))
+
+    def converter(row):
+        values = {name: parse(row[name]) for name, parse in parsers}
+        if table is User.__table__:
+            if args.hash_passwords:
+                values['password'] = bcrypt.hashpw(values['password'].encode('utf-8'), bcrypt.gensalt())
+            elif isinstance(values['password'], str):
+                values['password'] = values['password'].encode('utf-8')
+            # per-user values, the column defaults would be the same for every user.
+            # Same 32 character base32 secret as pyotp.random_base32(), which is too slow for millions of rows
+            if 'pin_key' not in header:
+                values['pin_key'] = base64.b32encode(secrets.token_bytes(20)).decode()
+            if 'registered_on' not in header:
+                values['registered_on'] = datetime.now()
+        return values
+    return converter
+
+
+def insert_statement(table, converter_columns, args):
+    if not args.upsert:
+        return db.insert(table)
+    statement = sqlite_insert(table)
+    # the column's onupdate is not applied to an ON CONFLICT update, updated users get their new change number here
+    updates = {name: statement.excluded[name] for name in converter_columns if name not in ('id', 'email')}
+    updates['change_seq'] = table.c.change_seq.onupdate.arg
+    return statement.on_conflict_do_update(index_elements=[table.c.email], set_=updates)
+
+
+def main():
+    args = parse_args()
+    if args.upsert and args.table != 'users':
+        sys.exit('--upsert is only supported for the users table')
+    table = TABLES[args.table]
+
+    with open(args.file, newline='') as csvfile:
+        header = next(csv.reader(csvfile), [])
+    converter = row_converter(table, header, args)
+    statement = insert_statement(table, [name for name in header if name in table.c and name != 'change_seq'], args)
+    batches_per_transaction = max(1, args.transaction_size // args.batch_size)
+
+    with app.app_context():
+        start = time.perf_counter()
+        rows = 0
+        batches = read_batches(args.file, args.batch_size)
+        while True:
+            loaded = 0
+            # every batch is a single executemany, committed together with the other batches of the transaction
+            with db.engine.begin() as connection:
+                for batch in islice(batches, batches_per_transaction):
+                    connection.execute(statement, [converter(row) for row in batch])
+                    loaded += len(batch)
+            if not loaded:
+                break
+            rows += loaded
+            elapsed = time.perf_counter() - start
+            print('%s: %d rows, %.0f rows/s' % (args.table, rows, rows / elapsed))
+
+        elapsed = time.perf_counter() - start
+        print('%s: loaded %d rows in %.1fs (%.0f rows/s)'
+              % (args.table, rows, elapsed, rows / elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+    main()
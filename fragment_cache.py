@@ -0,0 +1,89 @@
+# IMPORTS
+import threading
+
+from flask import current_app, g, has_request_context, request
+from flask_login import current_user
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+
+# Rendered template fragments of the current deploy, keyed by (template, fragment, role, locale). Entries of an
+# earlier deploy are dropped as soon as DEPLOY_ID changes
+class FragmentCache:
+    def __init__(self):
+        self._fragments = {}
+        self._lock = threading.Lock()
+        self._deploy_id = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, deploy_id, key, render):
+        with self._lock:
+            if deploy_id != self._deploy_id:
+                self._fragments.clear()
+                self._deploy_id = deploy_id
+            fragment = self._fragments.get(key)
+            if fragment is not None:
+                self.hits += 1
+                return fragment
+            self.misses += 1
+
+        fragment = render()
+        with self._lock:
+            if deploy_id == self._deploy_id:
+                self._fragments[key] = fragment
+        return fragment
+
+    # Drops every cached fragment, e.g. after templates are changed in place
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'deploy_id': self._deploy_id,
+                    'size': len(self._fragments),
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
+# Role of the current user as seen by the templates, 'anonymous' when nobody is logged in
+def fragment_role():
+    if current_user.is_authenticated:
+        return current_user.role
+    return 'anonymous'
+
+
+# Best supported locale of the request, the first of LOCALES if the client accepts none of them
+def fragment_locale():
+    locales = current_app.config['LOCALES']
+    if has_request_context():
+        return request.accept_languages.best_match(locales) or locales[0]
+    return locales[0]
+
+
+# Jinja extension adding {% cache 'name' %}...{% endcache %}. The body is rendered once per template, role and
+# locale and served from the cache afterwards, so it must not use anything else that varies per request (flash
+# messages, names, form tokens, draw lists)
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=FragmentCache())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [nodes.Const(parser.name), parser.parse_expression()]
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache', args), [], [], body).set_lineno(lineno)
+
+    def _cache(self, template, name, caller):
+        if not current_app.config['FRAGMENT_CACHE']:
+            return caller()
+        # role and locale are worked out once per request
+        variant = g.get('fragment_variant')
+        if variant is None:
+            variant = g.fragment_variant = (fragment_role(), fragment_locale())
+        key = (template, name) + variant
+        return self.environment.fragment_cache.get(current_app.config['DEPLOY_ID'], key, caller)
@@ -0,0 +1,79 @@
+# IMPORTS
+import threading
+import time
+
+from flask_login import UserMixin
+from app import app, db
+from models import User
+
+
+# Identity of a logged in user as returned by the Flask-Login user loader. It holds only the columns needed for
+# authentication, role checks and page headers. Any other attribute is read from, or written to, the full User row,
+# which is only loaded the first time it is needed in a request
+class CachedIdentity(UserMixin):
+    fields = ('id', 'email', 'firstname', 'role', 'key_version')
+
+    def __init__(self, values):
+        for name, value in zip(self.fields, values):
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, '_user', None)
+
+    # Full User row, loaded on first use
+    @property
+    def user(self):
+        if self._user is None:
+            object.__setattr__(self, '_user', db.session.get(User, self.id))
+        return self._user
+
+    def __getattr__(self, name):
+        return getattr(self.user, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.user, name, value)
+        if name in self.fields:
+            object.__setattr__(self, name, value)
+
+
+# Short-lived cache of identity columns by user id, so authenticated requests skip the users table
+class IdentityCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._next_sweep = 0
+
+    def load(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] > now:
+                return CachedIdentity(entry[1])
+
+        values = (db.session.query(*[getattr(User, name) for name in CachedIdentity.fields])
+                  .filter(User.id == user_id)
+                  .first())
+        if values is None:
+            return None
+
+        with self._lock:
+            # expired entries are swept at most once per ttl so the cache never outgrows the active users
+            if now >= self._next_sweep:
+                for expired in [key for key, entry in self._entries.items() if entry[0] <= now]:
+                    del self._entries[expired]
+                self._next_sweep = now + self.ttl
+            self._entries[user_id] = (now + self.ttl, tuple(values))
+        return CachedIdentity(values)
+
+    # Must be called whenever a cached column changes or the user logs out
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+identity_cache = IdentityCache(app.config['USER_CACHE_TTL'])
+
+
+# Any ORM update of a user (role change, key change, ...) drops its cached identity
+@db.event.listens_for(User, 'after_update')
+def invalidate_updated_user(mapper, connection, target):
+    identity_cache.invalidate(target.id)
@@ -0,0 +1,133 @@
+# IMPORTS
+import threading
+import time
+from collections import OrderedDict
+
+import rsa
+from app import app
+
+
+# Process-local LRU cache of decoded RSA keys. Entries are keyed by (kind, user id, key version) so a key change
+# is never served stale, and expire after ttl seconds
+class KeyCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Returns the cached key or None, counting the hit or miss
+    def lookup(self, kind, user_id, key_version):
+        cache_key = (kind, user_id, key_version)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self._entries[cache_key]
+            self.misses += 1
+            return None
+
+    # Stores a key, evicting the least recently used entries over the size limit
+    def store(self, kind, user_id, key_version, key):
+        cache_key = (kind, user_id, key_version)
+        with self._lock:
+            self._entries[cache_key] = (time.monotonic() + self.ttl, key)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    # Returns the key, calling loader() to decode it on a miss
+    def get(self, kind, user_id, key_version, loader):
+        key = self.lookup(kind, user_id, key_version)
+        if key is None:
+            key = loader()
+            self.store(kind, user_id, key_version, key)
+        return key
+
+    # Drops every cached key of a user
+    def invalidate(self, user_id):
+        with self._lock:
+            for cache_key in [cache_key for cache_key in self._entries if cache_key[1] == user_id]:
+                del self._entries[cache_key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries),
+                    'max_size': self.max_size,
+                    'ttl': self.ttl,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+key_cache = KeyCache(app.config['KEY_CACHE_SIZE'], app.config['KEY_CACHE_TTL'])
+
+
+# Public key of a user, used to encrypt draws
+def public_key(user):
+    return key_cache.get('public', user.id, user.key_version,
+                         lambda: rsa.PublicKey.load_pkcs1(user.public_key, 'DER'))
+
+
+# Private key of a user, used to decrypt draws
+def private_key(user):
+    return key_cache.get('private', user.id, user.key_version,
+                         lambda: rsa.PrivateKey.load_pkcs1(user.private_key, 'DER'))
+
+
+# Unwrapped data key of a user's envelope encrypted draws, or None if the user has no data key.
+# Unwrapping costs one RSA decryption per user, after that every draw is decrypted symmetrically. Only to be called
+# when envelope encrypted draws are decrypted (see envelope_draw_key), a user without a data key is never cached
+def draw_key(user):
+    key = key_cache.lookup('draw', user.id, user.key_version)
+    if key is None and user.draw_key is not None:
+        key = rsa.decrypt(user.draw_key, private_key(user))
+        key_cache.store('draw', user.id, user.key_version, key)
+    return key
+
+
+# Data key for decrypting draws, looked up only if one of them is envelope encrypted so users with RSA encrypted
+# draws only never load their user row for it
+def envelope_draw_key(user, draws):
+    if any(draw.envelope for draw in draws):
+        return draw_key(user)
+    return None
+
+
+# (private key, data key) of several users given (id, key version, has draw key) rows. Keys that are not cached
+# are loaded by load_blobs, which is called once with the list of missing user ids and returns
+# {user id: (DER encoded private key, wrapped data key)}. Users without a data key only need their private key
+def owner_keys(owners, load_blobs):
+    keys = {}
+    missing = {}
+    for owner in owners:
+        owner_private_key = key_cache.lookup('private', owner.id, owner.key_version)
+        owner_draw_key = None
+        if owner.has_draw_key and owner_private_key is not None:
+            owner_draw_key = key_cache.lookup('draw', owner.id, owner.key_version)
+        if owner_private_key is None or (owner.has_draw_key and owner_draw_key is None):
+            missing[owner.id] = owner.key_version
+        else:
+            keys[owner.id] = (owner_private_key, owner_draw_key)
+
+    if missing:
+        for user_id, (private_blob, draw_key_blob) in load_blobs(list(missing)).items():
+            owner_private_key = rsa.PrivateKey.load_pkcs1(private_blob, 'DER')
+            key_cache.store('private', user_id, missing[user_id], owner_private_key)
+            owner_draw_key = None
+            if draw_key_blob is not None:
+                owner_draw_key = rsa.decrypt(draw_key_blob, owner_private_key)
+                key_cache.store('draw', user_id, missing[user_id], owner_draw_key)
+            keys[user_id] = (owner_private_key, owner_draw_key)
+    return keys
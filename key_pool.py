@@ -0,0 +1,74 @@
+# IMPORTS
+import threading
+import time
+from collections import deque
+
+import rsa
+from app import app
+
+# size of the RSA keys given to users
+KEY_BITS = 512
+
+
+# Pool of pre-generated RSA key pairs. A background thread tops the pool up to the high watermark whenever it
+# drops below the low watermark, so registration normally takes a ready pair instead of generating one
+class KeyPairPool:
+    def __init__(self, low, high, bits=KEY_BITS):
+        self.low = low
+        self.high = high
+        self.bits = bits
+        self._pairs = deque()
+        self._refill_needed = threading.Event()
+        self._lock = threading.Lock()
+        self._worker = None
+        self.generated = 0
+        self.taken = 0
+        self.fallbacks = 0
+        self.generating_seconds = 0.0
+
+    # Starts the refill thread on first use, called on every request so it returns at once when already started
+    def start(self):
+        if self._worker is not None:
+            return
+        with self._lock:
+            if self._worker is None and self.high > 0:
+                self._worker = threading.Thread(target=self._refill, name='key-pair-pool', daemon=True)
+                self._worker.start()
+                self._refill_needed.set()
+
+    # Returns (public key, private key), generating the pair inline if the pool is empty
+    def take(self):
+        self.start()
+        try:
+            pair = self._pairs.popleft()
+            self.taken += 1
+        except IndexError:
+            pair = rsa.newkeys(self.bits)
+            self.fallbacks += 1
+
+        if len(self._pairs) < self.low:
+            self._refill_needed.set()
+        return pair
+
+    def _refill(self):
+        while True:
+            self._refill_needed.wait()
+            self._refill_needed.clear()
+            while len(self._pairs) < self.high:
+                start = time.perf_counter()
+                pair = rsa.newkeys(self.bits)
+                self.generating_seconds += time.perf_counter() - start
+                self._pairs.append(pair)
+                self.generated += 1
+
+    def stats(self):
+        return {'depth': len(self._pairs),
+                'low': self.low,
+                'high': self.high,
+                'generated': self.generated,
+                'taken': self.taken,
+                'fallbacks': self.fallbacks,
+                'refill_rate': self.generated / self.generating_seconds if self.generating_seconds else 0.0}
+
+
+key_pool = KeyPairPool(app.config['KEY_POOL_LOW'], app.config['KEY_POOL_HIGH'])
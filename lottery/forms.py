@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
-from wtforms import IntegerField, SubmitField
-from wtforms.validators import InputRequired, ValidationError, DataRequired
+from wtforms import IntegerField, SubmitField, TextAreaField
+from wtforms.validators import InputRequired, ValidationError, DataRequired, Optional, NumberRange
 
 
 class DrawForm(FlaskForm):
@@ -26,3 +26,11 @@ class DrawForm(FlaskForm):
             if len(fields) == 6:
                 return True
         return False
+
+
+class BulkDrawForm(FlaskForm):
+    # one draw per line
+    tickets = TextAreaField(validators=[Optional()])
+    # number of lucky dip draws to generate on the server
+    quick_picks = IntegerField(validators=[Optional(), NumberRange(min=0)])
+    submit = SubmitField("Submit Draws")
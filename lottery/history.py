@@ -0,0 +1,68 @@
+# IMPORTS
+from itertools import groupby
+
+from app import db
+from models import Draw, ArchivedDraw, decrypt_numbers
+
+
+# Columns shown by the draw history, the encrypted numbers are only decrypted for the draws of the current page
+def history_columns(model):
+    return (model.id, model.numbers, model.envelope, model.lottery_round, model.been_played, model.matches_master,
+            model.prize_tier)
+
+
+# A user's playable (played=False) or played draws, read from the user draws index. model is Draw for the live
+# draws or ArchivedDraw for the draws of closed rounds, lottery_round only keeps the draws of that round
+def user_draws(user_id, played, *entities, model=Draw, lottery_round=None):
+    query = (db.session.query(*entities)
+             .filter(model.user_id == user_id, model.been_played == played, model.master_draw.is_(False)))
+    if lottery_round is not None:
+        query = query.filter(model.lottery_round == lottery_round)
+    return query
+
+
+# Draw history, newest round first and newest draw first within a round. Pages are keyset paginated on
+# (lottery round, id): after continues past the last draw of the previous page
+def history_query(user_id, played, after=None, model=Draw, lottery_round=None):
+    query = user_draws(user_id, played, *history_columns(model), model=model, lottery_round=lottery_round)
+    if after is not None:
+        query = query.filter(db.tuple_(model.lottery_round, model.id) < db.tuple_(*after))
+    return query.order_by(model.lottery_round.desc(), model.id.desc())
+
+
+# Counts the draws of the history from the index alone, used for the page count
+def history_count_query(user_id, played, model=Draw, lottery_round=None):
+    return user_draws(user_id, played, db.func.count(model.id), model=model, lottery_round=lottery_round)
+
+
+# Returns (draws of the page, whether there is a next page). before goes back to the page ending just before the
+# first draw of the current page
+def history_page(user_id, played, page_size, after=None, before=None, model=Draw, lottery_round=None):
+    if before is not None:
+        draws = (user_draws(user_id, played, *history_columns(model), model=model, lottery_round=lottery_round)
+                 .filter(db.tuple_(model.lottery_round, model.id) > db.tuple_(*before))
+                 .order_by(model.lottery_round, model.id)
+                 .limit(page_size)
+                 .all())
+        return list(reversed(draws)), True
+
+    draws = history_query(user_id, played, after, model, lottery_round).limit(page_size + 1).all()
+    return draws[:page_size], len(draws) > page_size
+
+
+# Table holding the draws of a round: the archive once the round is closed, the live draws table until then
+def round_model(lottery_round):
+    closed = db.session.query(ArchivedDraw.id).filter_by(lottery_round=lottery_round, master_draw=False).first()
+    return Draw if closed is None else ArchivedDraw
+
+
+# Decrypts the draws of a page, returning dicts of the history columns with the plain text numbers
+def decrypt_page(draws, private_key, draw_key):
+    return [dict(draw._mapping, numbers=decrypt_numbers(draw.numbers, draw.envelope, private_key, draw_key))
+            for draw in draws]
+
+
+# Groups the draws of a page by lottery round as (round, draws), keeping the page order
+def group_by_round(draws):
+    return [(lottery_round, list(round_draws))
+            for lottery_round, round_draws in groupby(draws, key=lambda draw: draw['lottery_round'])]
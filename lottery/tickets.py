@@ -0,0 +1,53 @@
+# IMPORTS
+import re
+import secrets
+
+from app import db
+from models import Draw, new_draw_key
+import key_cache
+
+# numbers of a draw are picked from 1 to 60
+LOWEST_NUMBER = 1
+HIGHEST_NUMBER = 60
+NUMBERS_PER_DRAW = 6
+
+
+# Server side lucky dip, 6 unique numbers from 1 to 60 in size order like static/rng.js
+def quick_pick():
+    generator = secrets.SystemRandom()
+    return sorted(generator.sample(range(LOWEST_NUMBER, HIGHEST_NUMBER + 1), NUMBERS_PER_DRAW))
+
+
+# Parses one ticket per line, numbers separated by spaces or commas. Returns (tickets as lists of numbers,
+# errors) and every line is checked, so all mistakes are reported at once
+def parse_tickets(text):
+    tickets = []
+    errors = []
+    for line_number, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            numbers = [int(number) for number in re.split(r'[\s,]+', line.strip())]
+        except ValueError:
+            errors.append('Line %d: draw numbers must be whole numbers' % line_number)
+            continue
+        if len(numbers) != NUMBERS_PER_DRAW:
+            errors.append('Line %d: draw must contain 6 numbers' % line_number)
+        elif any(number < LOWEST_NUMBER or number > HIGHEST_NUMBER for number in numbers):
+            errors.append('Line %d: draw numbers must be in between 1 and 60' % line_number)
+        elif len(set(numbers)) != NUMBERS_PER_DRAW:
+            errors.append('Line %d: draw numbers must be unique' % line_number)
+        else:
+            tickets.append(numbers)
+    return tickets, errors
+
+
+# Encrypts the tickets of a user and inserts them in one transaction. The user's keys are looked up once for the
+# whole batch
+def submit_tickets(user, tickets):
+    public_key = key_cache.public_key(user)
+    draw_key = new_draw_key(user)
+    db.session.add_all([Draw(user_id=user.id, numbers=' '.join(str(number) for number in numbers), master_draw=False,
+                             lottery_round=0, public_key=public_key, draw_key=draw_key)
+                        for numbers in tickets])
+    db.session.commit()
@@ -1,11 +1,13 @@
 # IMPORTS
 from flask import Blueprint, render_template, request, flash, redirect, url_for
 from flask_login import login_required, current_user
-from app import db
-from lottery.forms import DrawForm
-from models import Draw, User
-from sqlalchemy.orm import make_transient
-import pickle
+from app import db, app
+from lottery.forms import DrawForm, BulkDrawForm
+from lottery.history import history_page, history_count_query, decrypt_page, group_by_round, round_model
+from lottery.tickets import quick_pick, parse_tickets, submit_tickets
+from models import Draw, ArchivedDraw, User, new_draw_key
+from round_results import latest_outcome
+import key_cache
 
 # CONFIG
 lottery_blueprint = Blueprint('lottery', __name__, template_folder='templates')
@@ -52,9 +54,9 @@ def create_draw():
         #                 draw_key=current_user.draw_pin)
 
         # Asymmetric create a new draw with the form data
-        crypto_key = pickle.loads(current_user.public_key)
+        crypto_key = key_cache.public_key(current_user)
         new_draw = Draw(user_id=current_user.id, numbers=submitted_numbers, master_draw=False, lottery_round=0,
-                        public_key=crypto_key)
+                        public_key=crypto_key, draw_key=new_draw_key(current_user))
 
         # add the new draw to the database
         db.session.add(new_draw)
@@ -67,11 +69,71 @@ def create_draw():
     return render_template('lottery/lottery.html', name=current_user.firstname, form=form)
 
 
-# view all draws that have not been played
+# submit many draws at once, typed one per line and/or generated as server side lucky dips
+@lottery_blueprint.route('/bulk_draws', methods=['GET', 'POST'])
+@login_required
+def bulk_draws():
+    form = BulkDrawForm()
+
+    if form.validate_on_submit():
+        tickets, errors = parse_tickets(form.tickets.data or '')
+        # never more lucky dips than needed to tell the submission is over the limit
+        tickets += [quick_pick() for _ in range(min(form.quick_picks.data or 0, app.config['MAX_BULK_TICKETS'] + 1))]
+
+        if errors:
+            flash(' '.join(errors))
+        elif not tickets:
+            flash('Enter draws or a number of lucky dips to submit')
+        elif len(tickets) > app.config['MAX_BULK_TICKETS']:
+            flash('At most %d draws can be submitted at once' % app.config['MAX_BULK_TICKETS'])
+        else:
+            submit_tickets(current_user, tickets)
+            flash('%d draws submitted.' % len(tickets))
+            return redirect(url_for('lottery.lottery'))
+
+    return render_template('lottery/lottery.html', name=current_user.firstname, bulk_form=form,
+                           max_bulk_tickets=app.config['MAX_BULK_TICKETS'])
+
+
+# Parses a draw history cursor of the form <lottery round>:<draw id>
+def history_cursor(value):
+    try:
+        lottery_round, draw_id = value.split(':')
+        return int(lottery_round), int(draw_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+# Loads and decrypts the page of a user's draw history requested by the pager form, returning
+# (decrypted draws, pager). model is Draw for the current round or ArchivedDraw for closed rounds, lottery_round
+# only keeps the draws of one round
+def draw_history(played, model=Draw, lottery_round=None):
+    page_size = app.config['DRAWS_PAGE_SIZE']
+    page = max(request.form.get('page', 1, type=int), 1)
+    draws, more = history_page(current_user.id, played, page_size,
+                               after=history_cursor(request.form.get('after')),
+                               before=history_cursor(request.form.get('before')),
+                               model=model, lottery_round=lottery_round)
+    if not draws:
+        return [], None
+
+    # Asymmetric or envelope decryption of the current page only, keys looked up once for the page
+    draws = decrypt_page(draws, key_cache.private_key(current_user), key_cache.envelope_draw_key(current_user, draws))
+
+    total = history_count_query(current_user.id, played, model, lottery_round).scalar()
+    pager = {'page': page,
+             'pages': max((total + page_size - 1) // page_size, page),
+             'total': total,
+             'after': '%d:%d' % (draws[-1]['lottery_round'], draws[-1]['id']) if more else None,
+             'before': '%d:%d' % (draws[0]['lottery_round'], draws[0]['id']) if page > 1 else None}
+    return draws, pager
+
+
+# view a page of the draws that have not been played
 @lottery_blueprint.route('/view_draws', methods=['POST'])
 def view_draws():
-    # get all draws that have not been played [played=0]
-    playable_draws = Draw.query.filter_by(been_played=False, user_id=current_user.id).all()
+    # get a page of the draws that have not been played [played=0]
+    playable_draws, pager = draw_history(played=False)
     '''
     # Symmetric decryption of each draw queried before view in it in browser
      for draw in playable_draws:
@@ -79,37 +141,56 @@ def view_draws():
          make_transient(draw)
          draw.view_numbers(current_user.draw_pin)
      '''
-    # Asymmetric decryption
-    for draw in playable_draws:
-        make_transient(draw)
-        crypto_key = pickle.loads(current_user.private_key)
-        draw.view_numbers(crypto_key)
 
     # if playable draws exist
     if len(playable_draws) != 0:
         # re-render lottery page with playable draws
-        return render_template('lottery/lottery.html', playable_draws=playable_draws)
+        return render_template('lottery/lottery.html', playable_draws=playable_draws, draws_pager=pager)
     else:
         flash('No playable draws.')
         return lottery()
 
 
-# view lottery results
+# view the user's outcome in the latest round, and on request a page of lottery results grouped by lottery round
 @lottery_blueprint.route('/check_draws', methods=['POST'])
 def check_draws():
-    # get played draws
-    played_draws = Draw.query.filter_by(been_played=True, user_id=current_user.id).all()
+    # the user's outcome in the latest round, a cached primary key lookup in the materialized results
+    outcome = latest_outcome(current_user.id)
 
-    # if played draws exist
-    if len(played_draws) != 0:
-        return render_template('lottery/lottery.html', results=played_draws, played=True,
+    # if the user did not play in the latest round [wait for next lottery round]
+    if outcome is None:
+        flash("Next round of lottery yet to play. Check you have playable draws.")
+        return lottery()
+
+    # checking results only reads the outcome, the played draws are loaded and decrypted when a page is asked for
+    if 'page' not in request.form:
+        return render_template('lottery/lottery.html', round_outcome=outcome, played=True,
                                name=current_user.firstname)
 
-    # if no played draws exist [all draw entries have been played therefore wait for next lottery round]
-    else:
-        flash("Next round of lottery yet to play. Check you have playable draws.")
+    # get a page of the draws played in the outcome's round, from the archive once the round is closed
+    played_draws, pager = draw_history(played=True, model=round_model(outcome['lottery_round']),
+                                       lottery_round=outcome['lottery_round'])
+    if len(played_draws) == 0:
+        flash("No played draws, the round's draws have been deleted.")
         return lottery()
 
+    return render_template('lottery/lottery.html', results=group_by_round(played_draws), played=True,
+                           results_pager=pager, round_outcome=outcome, name=current_user.firstname)
+
+
+# view a page of the user's draws in closed rounds, grouped by lottery round
+@lottery_blueprint.route('/past_draws', methods=['POST'])
+@login_required
+def past_draws():
+    archived_draws, pager = draw_history(played=True, model=ArchivedDraw)
+
+    if len(archived_draws) != 0:
+        return render_template('lottery/lottery.html', past_results=group_by_round(archived_draws),
+                               past_pager=pager, name=current_user.firstname)
+
+    flash("No draws in past rounds.")
+    return lottery()
+
 
 # delete all played draws
 @lottery_blueprint.route('/play_again', methods=['POST'])
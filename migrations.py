@@ -0,0 +1,308 @@
+# IMPORTS
+import pickle
+import sys
+
+import rsa
+from app import db, app
+from models import User, Draw, ArchivedDraw, RoundJob, RoundResult, RoundOutcome, numbers_digest
+from admin.user_search import users_query
+from lottery.history import history_query, history_count_query
+from admin.rounds import close_rounds
+from round_results import materialize_round, materialize_played_round
+
+
+# Adds a column declared on a model to an existing table created before the column existed
+def add_missing_column(column):
+    table = column.table
+    existing = [c['name'] for c in db.inspect(db.engine).get_columns(table.name)]
+    if column.name not in existing:
+        ddl = 'ALTER TABLE %s ADD COLUMN %s %s' % (table.name, column.name, column.type.compile(db.engine.dialect))
+        # existing rows get the column's default value
+        if column.default is not None and column.default.is_scalar:
+            ddl += ' DEFAULT %r' % (int(column.default.arg) if isinstance(column.default.arg, bool)
+                                    else column.default.arg)
+        db.session.execute(db.text(ddl))
+        db.session.commit()
+
+
+# Drops a column no longer declared on its model (SQLite 3.35 or later)
+def drop_column(table_name, column_name):
+    existing = [c['name'] for c in db.inspect(db.engine).get_columns(table_name)]
+    if column_name in existing:
+        db.session.execute(db.text('ALTER TABLE %s DROP COLUMN %s' % (table_name, column_name)))
+        db.session.commit()
+
+
+# MIGRATIONS
+# 1: key cache version, envelope encryption, blind index, prize tier columns and the round_jobs table. The change
+# counters are added here too as the bulk updates of the next migrations raise them (they are filled in by 11)
+def add_columns():
+    db.create_all()
+    add_missing_column(User.__table__.c.key_version)
+    add_missing_column(User.__table__.c.draw_key)
+    add_missing_column(Draw.__table__.c.numbers_digest)
+    add_missing_column(Draw.__table__.c.envelope)
+    add_missing_column(Draw.__table__.c.prize_tier)
+    add_change_columns()
+
+
+# Change counter columns of the tables whose rows are updated
+def add_change_columns():
+    for model in (User, Draw, RoundJob):
+        add_missing_column(model.__table__.c.change_seq)
+
+
+# 2: converts keys stored as pickled rsa objects to PKCS#1 DER, one chunk of users per commit.
+# Pickles start with the protocol opcode 0x80, DER keys with the SEQUENCE tag 0x30
+def migrate_keys_to_der(chunk_size=500):
+    last_id = 0
+    while True:
+        chunk = (db.session.query(User.id, User.public_key, User.private_key)
+                 .filter(User.id > last_id)
+                 .order_by(User.id)
+                 .limit(chunk_size)
+                 .all())
+        if not chunk:
+            break
+        last_id = chunk[-1].id
+
+        converted = [{'id': user.id,
+                      'public_key': pickle.loads(user.public_key).save_pkcs1('DER'),
+                      'private_key': pickle.loads(user.private_key).save_pkcs1('DER')}
+                     for user in chunk if user.private_key and user.private_key[:1] == b'\x80']
+        if converted:
+            db.session.execute(db.update(User), converted)
+            db.session.commit()
+
+
+# 3: computes the blind index for draws created before it existed, one chunk of draws per commit
+def backfill_draw_digests(chunk_size=1000):
+    last_id = 0
+    while True:
+        chunk = (db.session.query(Draw.id, Draw.user_id, Draw.numbers)
+                 .filter(Draw.numbers_digest.is_(None), Draw.id > last_id)
+                 .order_by(Draw.id)
+                 .limit(chunk_size)
+                 .all())
+        if not chunk:
+            break
+        last_id = chunk[-1].id
+
+        owners = {owner.id: rsa.PrivateKey.load_pkcs1(owner.private_key, 'DER') for owner in
+                  db.session.query(User.id, User.private_key).filter(User.id.in_({d.user_id for d in chunk}))}
+
+        db.session.execute(db.update(Draw), [
+            {'id': draw.id,
+             'numbers_digest': numbers_digest(rsa.decrypt(draw.numbers, owners[draw.user_id]).decode())}
+            for draw in chunk])
+        db.session.commit()
+
+
+# 4: indexes declared on the models, including the composite indexes of the draws hot queries. Existing indexes are
+# looked up by name, SQLAlchemy can not reflect the expression indexes of the user search
+def create_indexes():
+    with db.engine.connect() as connection:
+        existing = set(connection.execute(db.text("SELECT name FROM sqlite_master WHERE type = 'index'")).scalars())
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+
+
+# 6: the user draws index gains the lottery round so draw history pages are read in round order from the index
+def replace_user_draws_index():
+    db.session.execute(db.text('DROP INDEX IF EXISTS ix_draws_user_played'))
+    db.session.commit()
+    create_indexes()
+
+
+# 7: round archive table. Draws of rounds before the current one are moved to the archive, the current round
+# stays live until the next winning draw is generated
+def archive_past_rounds():
+    db.create_all()
+    current = Draw.query.filter_by(master_draw=True).first()
+    if current is not None:
+        close_rounds(current.lottery_round - 1)
+    else:
+        close_rounds(db.session.query(db.func.max(Draw.lottery_round)).scalar() or 0)
+
+
+# 8: materialized round results. Finished rounds whose draws are still live get their results written, rounds
+# already archived keep being read from the archive
+def materialize_finished_rounds():
+    db.create_all()
+    materialized = db.session.query(RoundResult.lottery_round)
+    for job in RoundJob.query.filter(RoundJob.status == 'finished', RoundJob.lottery_round.not_in(materialized)):
+        if Draw.query.filter_by(lottery_round=job.lottery_round, master_draw=False, been_played=True).first():
+            materialize_round(job)
+    db.session.commit()
+
+
+# 11: change counters of the incremental export. Existing rows are numbered by id, so a checkpoint taken on the id
+# before the counters existed still marks the rows already exported
+def add_change_counters():
+    add_change_columns()
+    for model in (User, Draw, RoundJob):
+        db.session.execute(db.text('UPDATE %s SET change_seq = id WHERE change_seq IS NULL' % model.__tablename__))
+    db.session.commit()
+    create_indexes()
+
+
+# 12: draws won before prize tiers were added to the jackpot tier. Only exact matches used to win, but migration 1
+# gave every existing draw the column's default of no prize
+def backfill_jackpot_tiers():
+    for model in (Draw, ArchivedDraw):
+        db.session.execute(db.update(model)
+                           .where(model.matches_master.is_(True), model.master_draw.is_(False), model.prize_tier == 0)
+                           .values(prize_tier=6))
+    db.session.commit()
+
+
+# 13: user search indexes on lower(email) and lower(lastname), so the admin search ignores case
+def replace_user_search_indexes():
+    db.session.execute(db.text('DROP INDEX IF EXISTS ix_users_role_email'))
+    db.session.execute(db.text('DROP INDEX IF EXISTS ix_users_role_lastname'))
+    db.session.commit()
+    create_indexes()
+
+
+# 14: draws table rebuilt with AUTOINCREMENT, SQLite otherwise hands the highest ids out again once their draws are
+# archived. Ids already handed out to draws that are gone but still referenced by round jobs are not used again
+def autoincrement_draw_ids():
+    old_columns = [c['name'] for c in db.inspect(db.engine).get_columns('draws')]
+    columns = ', '.join(column.name for column in Draw.__table__.c if column.name in old_columns)
+    indexes = db.session.execute(db.text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'draws' "
+                                         "AND sql IS NOT NULL")).scalars().all()
+
+    # one transaction, the indexes are dropped as their names are kept by the renamed table
+    for index in indexes:
+        db.session.execute(db.text('DROP INDEX %s' % index))
+    db.session.execute(db.text('ALTER TABLE draws RENAME TO draws_rebuild'))
+    Draw.__table__.create(db.session.connection())
+    db.session.execute(db.text('INSERT INTO draws (%s) SELECT %s FROM draws_rebuild' % (columns, columns)))
+    db.session.execute(db.text('DROP TABLE draws_rebuild'))
+
+    highest = max(db.session.query(db.func.max(Draw.id)).scalar() or 0,
+                  db.session.query(db.func.max(RoundJob.max_draw_id)).scalar() or 0,
+                  db.session.query(db.func.max(RoundJob.master_draw_id)).scalar() or 0)
+    db.session.execute(db.text("DELETE FROM sqlite_sequence WHERE name = 'draws'"))
+    db.session.execute(db.text("INSERT INTO sqlite_sequence (name, seq) VALUES ('draws', %d)" % highest))
+    db.session.commit()
+
+
+# 15: results of rounds played before round jobs existed, whose draws are still live or already archived. Migration 8
+# only covered rounds with a finished job, so users of an upgraded database saw no outcome for the rounds they played
+def materialize_played_rounds():
+    done = db.union(db.select(RoundJob.lottery_round), db.select(RoundResult.lottery_round))
+    for model in (Draw, ArchivedDraw):
+        played_rounds = (db.session.query(model.lottery_round).distinct()
+                         .filter(model.master_draw.is_(False), model.been_played.is_(True), model.lottery_round > 0,
+                                 model.lottery_round.not_in(done))
+                         .all())
+        for lottery_round, in played_rounds:
+            materialize_played_round(lottery_round, model)
+    db.session.commit()
+
+
+# Ordered schema migrations, the version of a database is kept in SQLite's user_version pragma
+MIGRATIONS = [
+    (1, add_columns),
+    (2, migrate_keys_to_der),
+    (3, backfill_draw_digests),
+    (4, create_indexes),
+    # 5: user search indexes of the admin page
+    (5, create_indexes),
+    (6, replace_user_draws_index),
+    (7, archive_past_rounds),
+    (8, materialize_finished_rounds),
+    # 9: role index giving the unsearched admin user list in id order
+    (9, create_indexes),
+    # 10: round results no longer keep a copy of the winners, whose draw ids change when the round is archived
+    (10, lambda: drop_column('round_results', 'winners')),
+    (11, add_change_counters),
+    (12, backfill_jackpot_tiers),
+    (13, replace_user_search_indexes),
+    (14, autoincrement_draw_ids),
+    (15, materialize_played_rounds),
+]
+
+
+def schema_version():
+    return db.session.execute(db.text('PRAGMA user_version')).scalar()
+
+
+def set_schema_version(version):
+    db.session.execute(db.text('PRAGMA user_version = %d' % version))
+    db.session.commit()
+
+
+# Marks a database created from the current models as up to date
+def stamp_db():
+    with app.app_context():
+        set_schema_version(MIGRATIONS[-1][0])
+
+
+# Applies every migration newer than the database, recording the version after each one so an interrupted
+# upgrade carries on from the step that failed
+def upgrade_db():
+    with app.app_context():
+        for version, migration in MIGRATIONS:
+            if version > schema_version():
+                migration()
+                set_schema_version(version)
+
+
+# QUERY PLANS
+# The hot draws queries of the lottery and admin views, each of which must be answered from an index
+def hot_queries():
+    return {
+        'view_draws': history_query(1, False, (0, 1)).limit(20),
+        'check_draws': history_query(1, True, (1, 1)).limit(20),
+        'draws_count': history_count_query(1, True),
+        'past_draws': history_query(1, True, (1, 1), ArchivedDraw).limit(20),
+        'past_draws_count': history_count_query(1, True, ArchivedDraw),
+        'archive_winners': ArchivedDraw.query.filter_by(master_draw=False, matches_master=True, lottery_round=1),
+        'archive_master': ArchivedDraw.query.filter_by(master_draw=True, lottery_round=1),
+        'play_again': Draw.query.filter_by(been_played=True, master_draw=False, user_id=1),
+        'generate_winning_draw': Draw.query.filter_by(master_draw=True),
+        'view_winning_draw': Draw.query.filter_by(master_draw=True, been_played=False),
+        'run_lottery': Draw.query.filter_by(master_draw=False, been_played=False),
+        'round_chunk': (db.session.query(Draw.id, Draw.user_id, Draw.numbers_digest)
+                        .filter_by(master_draw=False, been_played=False)
+                        .filter(Draw.id > 0, Draw.id <= 1)
+                        .order_by(Draw.id)
+                        .limit(1000)),
+        'round_size': (db.session.query(db.func.max(Draw.id), db.func.count(Draw.id))
+                       .filter_by(master_draw=False, been_played=False)),
+        'round_winners': Draw.query.filter_by(master_draw=False, matches_master=True, lottery_round=1),
+        'round_outcome': RoundOutcome.query.filter_by(user_id=1, lottery_round=1),
+        'round_result': RoundResult.query.filter_by(lottery_round=1),
+        'results_version': db.session.query(db.func.max(RoundResult.lottery_round)),
+        'view_all_users': users_query().limit(50),
+        'search_users_email': users_query('email', 'a', 1, 'a').limit(50),
+        'search_users_lastname': users_query('lastname', 'A', 1, 'A').limit(50),
+        'search_users_postcode': users_query('postcode', 'N', 1, 'N').limit(50),
+    }
+
+
+# Plan steps that read more than the requested range: a scan of a whole table or index (covering or not) and a
+# sort of every matching row into a temporary B-tree
+def unbounded_steps(query):
+    statement = query.statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+    plan = db.session.execute(db.text('EXPLAIN QUERY PLAN %s' % statement)).all()
+    return [row[-1] for row in plan if row[-1].startswith('SCAN') or 'USE TEMP B-TREE' in row[-1]]
+
+
+# Names of the hot queries that SQLite would answer with a full scan or sort, instead of an index range
+def full_scans():
+    return [name for name, query in hot_queries().items() if unbounded_steps(query)]
+
+
+# Upgrades the database and fails if any hot query falls back to a full scan or sort
+if __name__ == '__main__':
+    upgrade_db()
+    with app.app_context():
+        scans = full_scans()
+    if scans:
+        sys.exit('Full scan or sort in: %s' % ', '.join(scans))
+    print('Database at version %d, all hot queries use an index range.' % MIGRATIONS[-1][0])
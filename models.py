@@ -1,16 +1,37 @@
 import rsa
 
 from app import db, app
+import key_cache
+from key_pool import key_pool
 from flask_login import UserMixin
 from datetime import datetime
 import pyotp
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+import os
 import bcrypt
-import pickle
+import hmac
+import hashlib
+
+
+# Next value of a table's change counter. Every row inserted or updated gets one more than the table's highest value,
+# so an incremental export resumes after the highest value it exported. Writers are serialized by SQLite, a row
+# committed after an export started always gets a value above every row that export could see
+def next_change(table_name):
+    return db.text('(SELECT coalesce(max(change_seq), 0) + 1 FROM %s)' % table_name)
 
 
 class User(db.Model, UserMixin):
     __tablename__ = 'users'
+    __table_args__ = (
+        # users of a role in id order (the index ends in the rowid), for the unsearched admin user list
+        db.Index('ix_users_role', 'role'),
+        # prefix search of users by email, surname or postcode on the admin page. Emails and surnames are searched
+        # whatever their case, postcodes are stored in capitals
+        db.Index('ix_users_role_email_lower', 'role', db.func.lower(db.literal_column('email'))),
+        db.Index('ix_users_role_lastname_lower', 'role', db.func.lower(db.literal_column('lastname'))),
+        db.Index('ix_users_role_postcode', 'role', 'postcode'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -38,9 +59,19 @@ class User(db.Model, UserMixin):
     # Symmetric encryption
     # draw_pin = db.Column(db.BLOB, nullable=False, default=Fernet.generate_key())
 
-    # Asymmetric encryption
-    public_key = db.Column(db.BLOB, nullable=True)
-    private_key = db.Column(db.BLOB, nullable=True)
+    # Asymmetric encryption, PKCS#1 DER encoded keys.
+    # Deferred so they are only loaded by the requests that encrypt or decrypt draws
+    public_key = db.deferred(db.Column(db.BLOB, nullable=True))
+    private_key = db.deferred(db.Column(db.BLOB, nullable=True))
+    # Incremented whenever the key pair changes so cached keys of the old pair are never used
+    key_version = db.Column(db.Integer, nullable=False, default=1)
+
+    # Envelope encryption, symmetric data key for the user's draws wrapped with the user's public key
+    draw_key = db.deferred(db.Column(db.BLOB, nullable=True))
+
+    # Change counter, raised by every insert and update
+    change_seq = db.Column(db.Integer, nullable=False, default=next_change('users'), onupdate=next_change('users'),
+                           index=True)
 
     # Define the relationship to Draw
     draws = db.relationship('Draw')
@@ -60,8 +91,21 @@ class User(db.Model, UserMixin):
         self.last_login = None
         self.last_login_ip = None
         self.total_logins = 0
-        self.public_key = pickle.dumps(public_key)
-        self.private_key = pickle.dumps(private_key)
+        self.key_version = 1
+        self.public_key = public_key.save_pkcs1('DER')
+        self.private_key = private_key.save_pkcs1('DER')
+        self.draw_key = rsa.encrypt(AESGCM.generate_key(bit_length=128), public_key)
+
+    # Method to replace the user's key pair, dropping any cached copy of the old keys.
+    # The draw data key is re-wrapped so envelope encrypted draws stay readable
+    def set_keys(self, public_key, private_key):
+        if self.draw_key is not None:
+            old_private_key = rsa.PrivateKey.load_pkcs1(self.private_key, 'DER')
+            self.draw_key = rsa.encrypt(rsa.decrypt(self.draw_key, old_private_key), public_key)
+        self.public_key = public_key.save_pkcs1('DER')
+        self.private_key = private_key.save_pkcs1('DER')
+        self.key_version = (self.key_version or 1) + 1
+        key_cache.key_cache.invalidate(self.id)
 
     # Method to verify password at login
     def verify_password(self, password):
@@ -92,8 +136,53 @@ def decrypt(data, draw_key):
     return Fernet(draw_key).decrypt(data).decode('utf-8')
 
 
+# Envelope encryption of draw numbers with a user's AES-GCM data key, stored as nonce + ciphertext + tag
+def envelope_encrypt(data, draw_key):
+    nonce = os.urandom(12)
+    return nonce + AESGCM(draw_key).encrypt(nonce, bytes(data, 'utf-8'), None)
+
+
+def envelope_decrypt(data, draw_key):
+    return AESGCM(draw_key).decrypt(data[:12], data[12:], None).decode('utf-8')
+
+
+# Data key to encrypt a user's new draws with, or None when draws are encrypted with RSA only.
+# Users registered before envelope encryption get a data key the first time they need one
+def new_draw_key(user):
+    if app.config['DRAW_ENCRYPTION'] != 'envelope':
+        return None
+
+    draw_key = key_cache.draw_key(user)
+    if draw_key is None:
+        # only stored if no other request stored one first, so draws are never encrypted with a lost key
+        db.session.execute(db.update(User)
+                           .where(User.id == user.id, User.draw_key.is_(None))
+                           .values(draw_key=rsa.encrypt(AESGCM.generate_key(bit_length=128), key_cache.public_key(user))))
+        db.session.commit()
+        draw_key = key_cache.draw_key(user)
+    return draw_key
+
+
+# Keyed blind index of a set of draw numbers. Numbers are sorted first so the digest does not depend on the order
+# they were entered in, and the HMAC key keeps the 6-number space from being brute forced out of the database
+def numbers_digest(numbers):
+    canonical = ' '.join(str(number) for number in sorted(int(number) for number in numbers.split()))
+    return hmac.new(app.config['DRAW_INDEX_KEY'].encode(), canonical.encode(), hashlib.sha256).hexdigest()
+
+
 class Draw(db.Model):
     __tablename__ = 'draws'
+    __table_args__ = (
+        # a user's playable or played draws by round (lottery page draw history, play again)
+        db.Index('ix_draws_user_history', 'user_id', 'been_played', 'master_draw', 'lottery_round'),
+        # winning draw lookups and the round engine's keyset scan over unplayed user draws
+        db.Index('ix_draws_master_played', 'master_draw', 'been_played', 'id'),
+        # winners of a round
+        db.Index('ix_draws_round_winners', 'lottery_round', 'matches_master'),
+        # ids are never handed out again once their draws are archived or deleted, round jobs and exports rely on
+        # new draws getting higher ids
+        {'sqlite_autoincrement': True},
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -102,31 +191,48 @@ class Draw(db.Model):
 
     # 6 draw numbers submitted
     numbers = db.Column(db.String(200), nullable=False)
+    # Blind index of the numbers so winning draws can be found without decrypting every draw
+    numbers_digest = db.Column(db.String(64), nullable=True, index=True)
     # Draw has already been played (can only play draw once)
     been_played = db.Column(db.BOOLEAN, nullable=False, default=False)
 
     # Draw matches with master draw created by admin (True = draw is a winner)
     matches_master = db.Column(db.BOOLEAN, nullable=False, default=False)
 
+    # Number of winning numbers matched by a winning draw (prize tier), 0 if the draw did not win
+    prize_tier = db.Column(db.Integer, nullable=False, default=0)
+
     # True = draw is master draw created by admin. User draws are matched to master draw
     master_draw = db.Column(db.BOOLEAN, nullable=False)
 
     # Lottery round that draw is used
     lottery_round = db.Column(db.Integer, nullable=False, default=0)
 
+    # True = numbers encrypted with the owner's data key (envelope encryption), False = encrypted with RSA only
+    envelope = db.Column(db.BOOLEAN, nullable=False, default=False)
+
+    # Change counter, raised by every insert and update (rounds update every draw they play)
+    change_seq = db.Column(db.Integer, nullable=False, default=next_change('draws'), onupdate=next_change('draws'),
+                           index=True)
+
     # Symmetric encryption
     # def __init__(self, user_id, numbers, master_draw, lottery_round, draw_key):
 
-    # Asymmetric encryption
-    def __init__(self, user_id, numbers, master_draw, lottery_round, public_key):
+    # Asymmetric encryption, or envelope encryption when the owner's data key is given
+    def __init__(self, user_id, numbers, master_draw, lottery_round, public_key, draw_key=None):
         self.user_id = user_id
-        # Symmetric encryption
-        # self.numbers = encrypt(numbers, draw_key)
-
-        # Asymmetric encryption
-        self.numbers = rsa.encrypt(numbers.encode(), public_key)
+        if draw_key is not None:
+            # Envelope encryption
+            self.numbers = envelope_encrypt(numbers, draw_key)
+            self.envelope = True
+        else:
+            # Asymmetric encryption
+            self.numbers = rsa.encrypt(numbers.encode(), public_key)
+            self.envelope = False
+        self.numbers_digest = numbers_digest(numbers)
         self.been_played = False
         self.matches_master = False
+        self.prize_tier = 0
         self.master_draw = master_draw
         self.lottery_round = lottery_round
 
@@ -134,16 +240,121 @@ class Draw(db.Model):
     # def view_numbers(self, draw_key):
     #    self.numbers = decrypt(self.numbers, draw_key)
 
-    # Asymmetric decryption function
-    def view_numbers(self, private_key):
-        self.numbers = rsa.decrypt(self.numbers, private_key).decode()
+    # Asymmetric decryption function, envelope encrypted draws are decrypted with the owner's data key instead
+    def view_numbers(self, private_key, draw_key=None):
+        self.numbers = decrypt_numbers(self.numbers, self.envelope, private_key, draw_key)
+
+
+# Plain text numbers of an encrypted draw, for draws loaded as rows rather than Draw objects
+def decrypt_numbers(numbers, envelope, private_key, draw_key=None):
+    if envelope:
+        return envelope_decrypt(numbers, draw_key)
+    return rsa.decrypt(numbers, private_key).decode()
+
+
+class ArchivedDraw(db.Model):
+    __tablename__ = 'draws_archive'
+    __table_args__ = (
+        # SQLite has no table partitions, rounds are kept apart by indexes leading with the lottery round:
+        # a whole round (closing, admin results) or one user's draws by round (draw history)
+        db.Index('ix_draws_archive_round', 'lottery_round', 'master_draw', 'matches_master'),
+        db.Index('ix_draws_archive_user', 'user_id', 'been_played', 'master_draw', 'lottery_round'),
+    )
+
+    # Draws of closed lottery rounds, moved out of the draws table with the same columns. The archive numbers draws
+    # itself in the order they were archived
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False)
+    numbers = db.Column(db.String(200), nullable=False)
+    numbers_digest = db.Column(db.String(64), nullable=True)
+    been_played = db.Column(db.BOOLEAN, nullable=False, default=True)
+    matches_master = db.Column(db.BOOLEAN, nullable=False, default=False)
+    prize_tier = db.Column(db.Integer, nullable=False, default=0)
+    master_draw = db.Column(db.BOOLEAN, nullable=False)
+    lottery_round = db.Column(db.Integer, nullable=False)
+    envelope = db.Column(db.BOOLEAN, nullable=False, default=False)
+
+
+class RoundJob(db.Model):
+    __tablename__ = 'round_jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # Lottery round being run. Unique so the same round can never be started twice
+    lottery_round = db.Column(db.Integer, nullable=False, unique=True)
+
+    # Master draw the round is played against and the admin who started it
+    master_draw_id = db.Column(db.Integer, nullable=False)
+    started_by = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False)
+
+    # running, finished, failed (can be resumed) or abandoned (given up with the draws played so far)
+    status = db.Column(db.String(20), nullable=False, default='running')
+
+    # Highest user draw id in the round, draws submitted once the round has started wait for the next round
+    max_draw_id = db.Column(db.Integer, nullable=False)
+    # Number of user draws in the round
+    total = db.Column(db.Integer, nullable=False)
+
+    # Checkpoint, id of the last draw processed. Committed together with the draws it covers
+    last_draw_id = db.Column(db.Integer, nullable=False, default=0)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    # JSON object of winners per prize tier
+    tier_counts = db.Column(db.Text, nullable=False, default='{}')
+    error = db.Column(db.Text, nullable=True)
+
+    started_at = db.Column(db.DateTime(), nullable=False)
+    # Updated with every checkpoint, a running job that stops updating has lost its worker
+    updated_at = db.Column(db.DateTime(), nullable=False)
+
+    # Change counter, raised by every insert and update
+    change_seq = db.Column(db.Integer, nullable=False, default=next_change('round_jobs'),
+                           onupdate=next_change('round_jobs'), index=True)
+
+    def __init__(self, lottery_round, master_draw_id, started_by, max_draw_id, total):
+        self.lottery_round = lottery_round
+        self.master_draw_id = master_draw_id
+        self.started_by = started_by
+        self.status = 'running'
+        self.max_draw_id = max_draw_id
+        self.total = total
+        self.last_draw_id = 0
+        self.processed = 0
+        self.tier_counts = '{}'
+        self.started_at = datetime.now()
+        self.updated_at = self.started_at
+
+
+class RoundResult(db.Model):
+    __tablename__ = 'round_results'
+
+    # Results of a finished lottery round, written once in the same transaction that finishes the round
+    lottery_round = db.Column(db.Integer, primary_key=True)
+    master_draw_id = db.Column(db.Integer, nullable=False)
+    # Number of user draws played in the round
+    total_draws = db.Column(db.Integer, nullable=False)
+    # JSON object of winners per prize tier. The winners themselves are read from the draws of the round
+    tier_counts = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime(), nullable=False)
+
+
+class RoundOutcome(db.Model):
+    __tablename__ = 'round_outcomes'
+
+    # Outcome of a round for one user, keyed by user first so a user's latest result is a single primary key lookup
+    user_id = db.Column(db.Integer, db.ForeignKey(User.id), primary_key=True)
+    lottery_round = db.Column(db.Integer, primary_key=True)
+    # Number of the user's draws played in the round and how many of them won
+    draws = db.Column(db.Integer, nullable=False)
+    winning_draws = db.Column(db.Integer, nullable=False)
+    # Highest prize tier won, 0 if no draw won
+    best_tier = db.Column(db.Integer, nullable=False)
 
 
 def init_db():
     with app.app_context():
         db.drop_all()
         db.create_all()
-        public_key, private_key = rsa.newkeys(512)
+        public_key, private_key = key_pool.take()
         admin = User(email='admin@email.com',
                      password='Admin1!',
                      firstname='Alice',
@@ -157,3 +368,7 @@ def init_db():
 
         db.session.add(admin)
         db.session.commit()
+
+        # a new database already has the latest schema
+        from migrations import stamp_db
+        stamp_db()
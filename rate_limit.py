@@ -0,0 +1,82 @@
+# IMPORTS
+import threading
+import time
+from collections import OrderedDict
+
+from app import app
+
+
+# Token buckets by key, shared by every thread of the process. A bucket holds up to burst tokens and gains rate
+# tokens per second, each allowed request takes one. Buckets are kept in least recently used order: a bucket idle
+# for burst / rate seconds is full again, the same as a new one, so it is dropped without changing any decision.
+# Beyond max_buckets the least recently used bucket is dropped even if not yet full
+class TokenBucketLimiter:
+    def __init__(self, rate, burst, max_buckets):
+        self.rate = rate
+        self.burst = burst
+        self.max_buckets = max_buckets
+        self.refill_seconds = burst / rate
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.rejected = 0
+        self.evicted = 0
+
+    # Takes a token from key's bucket, returning False if the bucket is empty
+    def allow(self, key):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+                self.allowed += 1
+            else:
+                self.rejected += 1
+            self._buckets[key] = (tokens, now)
+            self._evict(now)
+            return allowed
+
+    # Drops refilled buckets from the least recently used end, and the oldest ones beyond max_buckets
+    def _evict(self, now):
+        while self._buckets:
+            key, (tokens, updated) = next(iter(self._buckets.items()))
+            if now - updated >= self.refill_seconds:
+                del self._buckets[key]
+            elif len(self._buckets) > self.max_buckets:
+                del self._buckets[key]
+                self.evicted += 1
+            else:
+                break
+
+    def stats(self):
+        with self._lock:
+            return {'buckets': len(self._buckets),
+                    'max_buckets': self.max_buckets,
+                    'allowed': self.allowed,
+                    'rejected': self.rejected,
+                    'evicted': self.evicted}
+
+
+login_ip_limiter = TokenBucketLimiter(app.config['LOGIN_IP_RATE'] / 60, app.config['LOGIN_IP_BURST'],
+                                      app.config['LOGIN_MAX_BUCKETS'])
+login_email_limiter = TokenBucketLimiter(app.config['LOGIN_EMAIL_RATE'] / 60, app.config['LOGIN_EMAIL_BURST'],
+                                         app.config['LOGIN_MAX_BUCKETS'])
+
+
+# Takes a login attempt from the buckets of the client's ip address and of the email it logs in as. Returns False
+# if either is empty. An attempt refused by its ip address does not use up a token of the email
+def login_allowed(ip, email):
+    if not login_ip_limiter.allow(ip):
+        return False
+    return login_email_limiter.allow(email.strip().lower())
+
+
+def login_limiter_stats():
+    return {'ip': login_ip_limiter.stats(),
+            'email': login_email_limiter.stats()}
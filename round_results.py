@@ -0,0 +1,143 @@
+# IMPORTS
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from app import app, db
+from models import Draw, RoundResult, RoundOutcome
+
+
+# Inserts one outcome row per user who played in the round, from the round's played draws in the live draws table
+# (model Draw) or the archive (model ArchivedDraw)
+def insert_outcomes(lottery_round, model=Draw):
+    played = db.and_(model.lottery_round == lottery_round, model.master_draw.is_(False), model.been_played.is_(True))
+
+    db.session.execute(db.insert(RoundOutcome).from_select(
+        ('user_id', 'lottery_round', 'draws', 'winning_draws', 'best_tier'),
+        db.select(model.user_id, db.literal(lottery_round), db.func.count(model.id),
+                  db.func.sum(db.case((model.matches_master.is_(True), 1), else_=0)), db.func.max(model.prize_tier))
+        .where(played)
+        .group_by(model.user_id)))
+
+
+# Writes the results of a finished round: the round summary and one outcome row per user who played. Added to the
+# session of the transaction that marks the round job finished, so a finished round always has its results
+def materialize_round(job):
+    insert_outcomes(job.lottery_round)
+    db.session.add(RoundResult(lottery_round=job.lottery_round,
+                               master_draw_id=job.master_draw_id,
+                               total_draws=job.processed,
+                               tier_counts=job.tier_counts,
+                               created_at=datetime.now()))
+
+
+# Writes the results of a round played before round jobs existed from the round's played draws, live or archived.
+# There is no job to take the summary from, the draws and the winners per prize tier are counted instead. The master
+# draw of such a round may be gone, it was deleted when the next winning draw was generated, its id is then 0
+def materialize_played_round(lottery_round, model=Draw):
+    insert_outcomes(lottery_round, model)
+
+    tier_counts = {tier: 0 for tier in app.config['PRIZE_TIERS']}
+    total = 0
+    for prize_tier, matches_master, count in (
+            db.session.query(model.prize_tier, model.matches_master, db.func.count(model.id))
+            .filter_by(lottery_round=lottery_round, master_draw=False, been_played=True)
+            .group_by(model.prize_tier, model.matches_master)):
+        total += count
+        if matches_master:
+            tier_counts[prize_tier] = tier_counts.get(prize_tier, 0) + count
+    master_draw_id = db.session.query(model.id).filter_by(lottery_round=lottery_round, master_draw=True).scalar()
+
+    db.session.add(RoundResult(lottery_round=lottery_round,
+                               master_draw_id=master_draw_id or 0,
+                               total_draws=total,
+                               tier_counts=json.dumps(tier_counts),
+                               created_at=datetime.now()))
+
+
+# Process-local cache of round results. Every entry belongs to a results version, the latest round with results,
+# and the whole cache is dropped when a new round's results appear. The version is re-read from the database at
+# most once every version_ttl seconds, so other processes see a new round within that time
+class ResultsCache:
+    def __init__(self, max_size, version_ttl):
+        self.max_size = max_size
+        self.version_ttl = version_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._version_expires = 0
+        self.hits = 0
+        self.misses = 0
+
+    # Latest lottery round with results
+    def version(self):
+        if self._version is None or time.monotonic() >= self._version_expires:
+            self.set_version(db.session.query(db.func.max(RoundResult.lottery_round)).scalar() or 0)
+        return self._version
+
+    # Moves the cache to a new version, dropping every entry of the old one
+    def set_version(self, version):
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            self._version_expires = time.monotonic() + self.version_ttl
+
+    # Returns the cached value, calling loader() to load it on a miss. None is cached like any other value
+    def get(self, key, loader):
+        version = self.version()
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        value = loader()
+        with self._lock:
+            # a value loaded while the version changed belongs to the old version and is not kept
+            if version == self._version:
+                self._entries[key] = value
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {'version': self._version,
+                    'size': len(self._entries),
+                    'max_size': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
+results_cache = ResultsCache(app.config['RESULTS_CACHE_SIZE'], app.config['RESULTS_VERSION_TTL'])
+
+
+# Summary of a round as a dict, or None if the round has no results
+def round_summary(lottery_round):
+    def load():
+        result = db.session.get(RoundResult, lottery_round)
+        if result is None:
+            return None
+        return {'lottery_round': result.lottery_round,
+                'total_draws': result.total_draws,
+                'tier_counts': json.loads(result.tier_counts)}
+    return results_cache.get(('summary', lottery_round), load)
+
+
+# A user's outcome in the latest round with results as a dict, or None if the user did not play in it
+def latest_outcome(user_id):
+    lottery_round = results_cache.version()
+
+    def load():
+        outcome = db.session.get(RoundOutcome, (user_id, lottery_round))
+        if outcome is None:
+            return None
+        return {'lottery_round': outcome.lottery_round,
+                'draws': outcome.draws,
+                'winning_draws': outcome.winning_draws,
+                'best_tier': outcome.best_tier}
+    return results_cache.get(('outcome', user_id), load)
@@ -0,0 +1,107 @@
+# IMPORTS
+# Structured store of security events in a local SQLite file, written in batches by the security log listener
+import os
+import sqlite3
+from datetime import datetime
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS security_events (
+           id INTEGER PRIMARY KEY,
+           created TEXT NOT NULL,
+           event TEXT NOT NULL,
+           user_id INTEGER,
+           email TEXT,
+           ip TEXT,
+           message TEXT NOT NULL)''',
+    # every search is newest first by id, so the filtered column is followed by id
+    'CREATE INDEX IF NOT EXISTS ix_security_events_ip ON security_events (ip, id)',
+    'CREATE INDEX IF NOT EXISTS ix_security_events_user ON security_events (user_id, id)',
+    'CREATE INDEX IF NOT EXISTS ix_security_events_email ON security_events (email, id)',
+    'CREATE INDEX IF NOT EXISTS ix_security_events_created ON security_events (created)',
+]
+
+COLUMNS = ('id', 'created', 'event', 'user_id', 'email', 'ip', 'message')
+
+
+# Structured fields of a security event, passed to the security logger as extra
+def security_event(event, user_id=None, email=None, ip=None):
+    return {'event': event, 'user_id': user_id, 'email': email, 'ip': ip}
+
+
+def connect(path):
+    connection = sqlite3.connect(path)
+    for statement in SCHEMA:
+        connection.execute(statement)
+    return connection
+
+
+# Listener handler inserting the records logged with a security_event into the store, one transaction per batch.
+# The connection is opened by, and only used from, the listener thread. A batch that cannot be stored (unopenable
+# path, locked database, full disk) is counted as failed and the connection reopened for the next batch, so the
+# log file keeps being written
+class SecurityEventHandler:
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self.failed = 0
+        self.last_error = None
+
+    def emit_batch(self, records):
+        rows = [(datetime.fromtimestamp(record.created).isoformat(' ', 'seconds'), record.event,
+                 record.user_id, record.email, record.ip, record.getMessage())
+                for record in records if hasattr(record, 'event')]
+        if not rows:
+            return
+        try:
+            if self._connection is None:
+                self._connection = connect(self.path)
+            with self._connection:
+                self._connection.executemany('INSERT INTO security_events (created, event, user_id, email, ip, '
+                                             'message) VALUES (?, ?, ?, ?, ?, ?)', rows)
+        except sqlite3.Error as error:
+            self.failed += len(rows)
+            self.last_error = repr(error)
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+# Returns up to limit events matching the filters, newest first, and the id to pass as before for the next page
+# (None on the last page). Filters: event, ip, user_id, email (exact) and since/until (created time range)
+def search(path, filters, before=None, limit=50):
+    conditions = []
+    parameters = []
+    for column in ('event', 'ip', 'user_id', 'email'):
+        if filters.get(column) is not None:
+            conditions.append('%s = ?' % column)
+            parameters.append(filters[column])
+    if filters.get('since'):
+        conditions.append('created >= ?')
+        parameters.append(filters['since'])
+    if filters.get('until'):
+        conditions.append('created <= ?')
+        parameters.append(filters['until'])
+    if before is not None:
+        conditions.append('id < ?')
+        parameters.append(before)
+
+    query = 'SELECT %s FROM security_events' % ', '.join(COLUMNS)
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    # one row more than the page tells whether there is a next page
+    query += ' ORDER BY id DESC LIMIT ?'
+    parameters.append(limit + 1)
+
+    # nothing has been logged yet
+    if not os.path.isfile(path):
+        return [], None
+    # read only, the schema is created by the writing handler
+    connection = sqlite3.connect(path)
+    try:
+        events = [dict(zip(COLUMNS, row)) for row in connection.execute(query, parameters)]
+    finally:
+        connection.close()
+
+    if len(events) > limit:
+        return events[:limit], events[limit - 1]['id']
+    return events, None
@@ -0,0 +1,119 @@
+# IMPORTS
+# Queue based logging: request threads only put records on a bounded queue, a listener thread writes them in batches
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import traceback
+
+
+# Handler used by request threads. Records are put on the queue without blocking and dropped, and counted, when the
+# queue is full so a slow disk never holds up a request
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# Writes a whole batch of records before flushing the file once, rolling the file over when needed.
+# Mixed into the rotating file handlers, which provide shouldRollover and doRollover
+class BatchWriteMixin:
+    def emit_batch(self, records):
+        self.acquire()
+        try:
+            for record in records:
+                if record.levelno < self.level or not self.filter(record):
+                    continue
+                try:
+                    if self.shouldRollover(record):
+                        self.doRollover()
+                    if self.stream is None:
+                        self.stream = self._open()
+                    self.stream.write(self.format(record) + self.terminator)
+                except Exception:
+                    self.handleError(record)
+            if self.stream is not None:
+                self.stream.flush()
+        finally:
+            self.release()
+
+
+class BatchRotatingFileHandler(BatchWriteMixin, logging.handlers.RotatingFileHandler):
+    pass
+
+
+class BatchTimedRotatingFileHandler(BatchWriteMixin, logging.handlers.TimedRotatingFileHandler):
+    pass
+
+
+# Thread taking records off the queue and passing them to its handlers in batches of up to batch_size records.
+# A batch is whatever has queued up since the last write, so records are never held back waiting for a full batch
+class BatchQueueListener:
+    _sentinel = None
+
+    def __init__(self, log_queue, handlers, batch_size):
+        self.queue = log_queue
+        self.handlers = list(handlers)
+        self.batch_size = batch_size
+        self._thread = None
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor, name='security-log', daemon=True)
+        self._thread.start()
+
+    # Writes out everything already queued and stops the thread, waiting at most timeout seconds so exit never
+    # hangs on a full queue
+    def stop(self, timeout=5):
+        if self._thread is not None:
+            try:
+                self.queue.put(self._sentinel, timeout=timeout)
+            except queue.Full:
+                pass
+            else:
+                self._thread.join(timeout)
+            self._thread = None
+
+    def _monitor(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            record = self.queue.get()
+            while True:
+                if record is self._sentinel:
+                    stopping = True
+                    break
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if batch:
+                # a failing handler is reported and skipped, it must not stop the thread or the other handlers
+                for handler in self.handlers:
+                    try:
+                        handler.emit_batch(batch)
+                    except Exception:
+                        self.errors += 1
+                        traceback.print_exc(file=sys.stderr)
+                self.written += len(batch)
+                self.batches += 1
+
+
+# Returns the file handler for the log file, rotated by size ('size') or time ('time')
+def rotating_file_handler(path, rotation, max_bytes, backup_count, when):
+    if rotation == 'time':
+        return BatchTimedRotatingFileHandler(path, when=when, backupCount=backup_count)
+    return BatchRotatingFileHandler(path, 'a', maxBytes=max_bytes, backupCount=backup_count)
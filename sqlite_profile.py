@@ -0,0 +1,87 @@
+# IMPORTS
+from sqlalchemy.engine import make_url
+
+# Connection settings of the lottery database by profile. 'default' leaves SQLite and the connection pool as they
+# are. 'production' lets readers carry on while run_lottery writes (WAL), only syncs at checkpoints, waits up to
+# 5 seconds for a lock instead of failing with "database is locked", and gives each connection 256MB of memory
+# mapped I/O and a 64MB page cache
+PROFILES = {
+    'default': {
+        'pragmas': {},
+        'pool': {},
+    },
+    'production': {
+        'pragmas': {'busy_timeout': 5000,
+                    'journal_mode': 'WAL',
+                    'synchronous': 'NORMAL',
+                    'mmap_size': 256 * 1024 * 1024,
+                    'cache_size': -64 * 1024},
+        'pool': {'pool_size': 10,
+                 'max_overflow': 10,
+                 'pool_recycle': 3600},
+    },
+}
+
+
+# Upper case value if it is one of choices
+def choice(value, choices):
+    if value.upper() not in choices:
+        raise ValueError('%s is not one of %s' % (value, ', '.join(choices)))
+    return value.upper()
+
+
+# PRAGMA values each setting accepts, any other value fails at startup
+JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+PRAGMA_TYPES = {
+    'busy_timeout': int,
+    'journal_mode': lambda value: choice(value, JOURNAL_MODES),
+    'synchronous': lambda value: choice(value, SYNCHRONOUS_LEVELS),
+    'mmap_size': int,
+    'cache_size': int,
+}
+POOL_TYPES = {
+    'pool_size': int,
+    'max_overflow': int,
+    'pool_recycle': int,
+    'pool_timeout': int,
+}
+
+
+# Settings of a profile, each overridden by its environment variable if set: SQLITE_<PRAGMA> for pragmas,
+# SQLALCHEMY_<POOL OPTION> for pool options
+def profile_settings(name, environ, prefix, types, section):
+    if name not in PROFILES:
+        raise ValueError('Unknown SQLite profile %s, expected one of %s' % (name, ', '.join(PROFILES)))
+    settings = dict(PROFILES[name][section])
+    for setting, parse in types.items():
+        value = environ.get(prefix + setting.upper())
+        if value is not None:
+            settings[setting] = parse(value)
+    return settings
+
+
+# PRAGMA statements run on every new connection, busy_timeout first so the others wait for locks
+def sqlite_pragmas(name, environ):
+    pragmas = profile_settings(name, environ, 'SQLITE_', PRAGMA_TYPES, 'pragmas')
+    return dict(sorted(pragmas.items(), key=lambda pragma: pragma[0] != 'busy_timeout'))
+
+
+# Engine options for Flask-SQLAlchemy. In-memory SQLite databases live in a single connection, so they keep the
+# default pool
+def engine_options(name, database_uri, environ):
+    pool = profile_settings(name, environ, 'SQLALCHEMY_', POOL_TYPES, 'pool')
+    url = make_url(database_uri) if database_uri else None
+    if url is not None and url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        return {}
+    return pool
+
+
+# Connect event listener applying the pragmas to each new DBAPI connection
+def pragma_listener(pragmas):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+    return set_pragmas
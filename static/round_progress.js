@@ -0,0 +1,30 @@
+// JavaScript poller showing the progress of a running lottery round, loads the results once the round finishes
+window.addEventListener('load', function () {
+    var progress = document.getElementById('round-progress');
+
+    function poll() {
+        fetch(progress.dataset.progressUrl, {credentials: 'same-origin'})
+            .then(function (response) {
+                return response.json();
+            })
+            .then(function (job) {
+                if (job.status === 'finished') {
+                    window.location = progress.dataset.resultsUrl;
+                    return;
+                }
+                progress.textContent = 'Round ' + job.lottery_round + ': ' + job.processed + ' of ' + job.total
+                    + ' draws played (' + Math.round(job.draws_per_second) + ' draws/s)';
+                if (job.status === 'failed') {
+                    progress.textContent += '. Round failed, click Run Lottery to resume or Abandon Round to give up.';
+                    return;
+                }
+                if (job.status === 'abandoned') {
+                    progress.textContent += '. Round abandoned.';
+                    return;
+                }
+                setTimeout(poll, 1000);
+            });
+    }
+
+    poll();
+});
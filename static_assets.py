@@ -0,0 +1,92 @@
+# IMPORTS
+import json
+import mimetypes
+import os
+
+from flask import Blueprint, abort, make_response, request, send_from_directory, session, url_for
+
+# CONFIG
+assets_blueprint = Blueprint('assets', __name__)
+
+# encodings of the precompressed variants written by build_static.py, in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+# fingerprinted files never change, so clients may keep them for a year without revalidating
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+# Fingerprinted asset names and prebuilt error pages from the last build, empty if nothing was built
+class AssetBuild:
+    def __init__(self):
+        self.directory = None
+        self.manifest = {}
+        self.files = set()
+        self.error_pages = {}
+
+    def load(self, directory):
+        self.directory = directory
+        manifest_path = os.path.join(directory, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            return
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.manifest = manifest['assets']
+        self.files = set(self.manifest.values())
+        # error pages are small and kept in memory with every encoding
+        for code in manifest['error_pages']:
+            page = os.path.join(directory, 'errors', '%s.html' % code)
+            for encoding, suffix in (('identity', ''),) + ENCODINGS:
+                if os.path.exists(page + suffix):
+                    with open(page + suffix, 'rb') as page_file:
+                        self.error_pages[int(code), encoding] = page_file.read()
+
+
+asset_build = AssetBuild()
+
+
+# Encodings the client accepts, most preferred first, among those precompressed variants exist for
+def accepted_encodings():
+    return [(encoding, suffix) for encoding, suffix in ENCODINGS if request.accept_encodings[encoding]]
+
+
+# Drop-in for url_for: static files that were built get their fingerprinted asset URL, anything else is passed on
+def asset_url(endpoint, **values):
+    if endpoint == 'static' and values.get('filename') in asset_build.manifest:
+        return url_for('assets.asset', filename=asset_build.manifest[values.pop('filename')], **values)
+    return url_for(endpoint, **values)
+
+
+# Prebuilt error page for anonymous visitors in the best accepted encoding, or None to render the template
+def prebuilt_error_page(code):
+    # logged in users see their own navigation. The session is checked instead of current_user so no user is loaded
+    if '_user_id' in session or (code, 'identity') not in asset_build.error_pages:
+        return None
+    for encoding, suffix in accepted_encodings() + [('identity', '')]:
+        page = asset_build.error_pages.get((code, encoding))
+        if page is not None:
+            response = make_response(page, code)
+            response.content_type = 'text/html; charset=utf-8'
+            response.vary.add('Accept-Encoding')
+            if encoding != 'identity':
+                response.content_encoding = encoding
+            return response
+
+
+# VIEWS
+# fingerprinted static asset, precompressed variant by Accept-Encoding
+@assets_blueprint.route('/assets/<path:filename>')
+def asset(filename):
+    # only files of the build are served, which also keeps the path inside the build directory
+    if filename not in asset_build.files:
+        abort(404)
+    directory = asset_build.directory
+    response = None
+    for encoding, suffix in accepted_encodings():
+        if os.path.exists(os.path.join(directory, filename + suffix)):
+            response = send_from_directory(directory, filename + suffix, mimetype=mimetypes.guess_type(filename)[0])
+            response.content_encoding = encoding
+            break
+    if response is None:
+        response = send_from_directory(directory, filename)
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.vary.add('Accept-Encoding')
+    return response
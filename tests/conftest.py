@@ -0,0 +1,37 @@
+# The app reads its configuration from the environment when it is imported, so the test settings are put in place
+# before anything imports it
+import os
+import sys
+import tempfile
+
+import pytest
+
+TEST_DIR = tempfile.mkdtemp(prefix='lottery-tests-')
+os.environ.update({
+    'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(TEST_DIR, 'lottery.db'),
+    'SECRET_KEY': 'test secret key',
+    'DRAW_INDEX_KEY': 'test draw index key',
+    'SECURITY_EVENTS_DB': os.path.join(TEST_DIR, 'security_events.db'),
+    'LOG_FILE': os.path.join(TEST_DIR, 'lottery.log'),
+    'ASSET_BUILD_DIR': os.path.join(TEST_DIR, 'build'),
+    # key pairs are generated when needed instead of by the pool's background thread
+    'KEY_POOL_HIGH': '0',
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db  # noqa: E402
+import models  # noqa: E402
+import key_cache  # noqa: E402
+from round_results import results_cache  # noqa: E402
+
+
+# A new database with only the admin user, inside an app context. Process-local caches are emptied as ids are
+# reused by every new database
+@pytest.fixture
+def database():
+    models.init_db()
+    key_cache.key_cache.clear()
+    results_cache.set_version(None)
+    with app.app_context():
+        yield db
+        db.session.remove()
@@ -0,0 +1,19 @@
+from csv_db import value_parser
+from models import User, Draw
+
+
+def test_bytes_are_read_back_from_their_literal():
+    assert value_parser(User.__table__.c.public_key)("b'\\x30\\x82'") == b'\x30\x82'
+    assert value_parser(User.__table__.c.password)("b'$2b$12$hash'") == b'$2b$12$hash'
+    assert value_parser(Draw.__table__.c.numbers)("b'\\x00cipher'") == b'\x00cipher'
+
+
+def test_text_that_looks_like_bytes_is_kept():
+    assert value_parser(User.__table__.c.lastname)("b'Smith") == "b'Smith"
+    assert value_parser(User.__table__.c.firstname)("b'Ann'") == "b'Ann'"
+
+
+def test_values_get_the_column_type():
+    assert value_parser(Draw.__table__.c.been_played)('True') is True
+    assert value_parser(Draw.__table__.c.lottery_round)('3') == 3
+    assert value_parser(User.__table__.c.last_login)('') is None
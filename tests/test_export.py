@@ -0,0 +1,79 @@
+import csv
+from argparse import Namespace
+from datetime import datetime
+
+import pytest
+from sqlalchemy import insert
+
+import to_csv
+from models import User, Draw, RoundResult
+
+
+@pytest.fixture
+def export(database, tmp_path):
+    # Exports one table like an incremental to_csv.py run, returning the rows written and the new checkpoint
+    def run(name, since=None):
+        args = Namespace(output_dir=str(tmp_path), batch_size=2, gzip=False)
+        metadata = to_csv.reflect(database.engine)
+        with database.engine.connect() as connection:
+            written, highest = to_csv.export(connection, metadata, name, args, since)
+        with open(tmp_path / (name + '.csv'), newline='') as csvfile:
+            rows = list(csv.DictReader(csvfile))
+        assert len(rows) == written
+        return rows, highest
+    return run
+
+
+def add_draws(db, count, lottery_round=0, played=False):
+    db.session.execute(insert(Draw), [
+        {'user_id': 1, 'numbers': b'cipher', 'numbers_digest': None, 'been_played': played, 'matches_master': False,
+         'prize_tier': 0, 'master_draw': False, 'lottery_round': lottery_round, 'envelope': False}
+        for _ in range(count)])
+    db.session.commit()
+
+
+def test_incremental_export_includes_changed_rows(database, export):
+    add_draws(database, 3)
+    rows, checkpoint = export('draws')
+    assert len(rows) == 3
+    assert export('draws', checkpoint)[0] == []
+
+    # a round plays the first draw and a new draw is submitted
+    Draw.query.filter(Draw.id == 1).update({Draw.been_played: True, Draw.lottery_round: 1})
+    database.session.commit()
+    add_draws(database, 1)
+
+    rows, _ = export('draws', checkpoint)
+    assert [(row['id'], row['been_played']) for row in rows] == [('1', 'True'), ('4', 'False')]
+
+
+def test_user_logins_are_exported_again(database, export):
+    rows, checkpoint = export('users')
+    assert [row['email'] for row in rows] == ['admin@email.com']
+
+    assert export('users', checkpoint)[0] == []
+
+    # a login updates the user
+    admin = database.session.get(User, 1)
+    admin.total_logins = 1
+    database.session.commit()
+    assert [row['total_logins'] for row in export('users', checkpoint)[0]] == ['1']
+
+
+def test_results_only_include_rounds_with_results(database, export):
+    # round 1 has finished, round 2 is still being played
+    add_draws(database, 2, lottery_round=1, played=True)
+    add_draws(database, 1, lottery_round=2, played=True)
+    database.session.add(RoundResult(lottery_round=1, master_draw_id=0, total_draws=2, tier_counts='{}',
+                                     created_at=datetime.now()))
+    database.session.commit()
+
+    rows, checkpoint = export(to_csv.RESULTS)
+    assert [row['lottery_round'] for row in rows] == ['1', '1']
+
+    add_draws(database, 1, lottery_round=2, played=True)
+    database.session.add(RoundResult(lottery_round=2, master_draw_id=0, total_draws=2, tier_counts='{}',
+                                     created_at=datetime.now()))
+    database.session.commit()
+    rows, _ = export(to_csv.RESULTS, checkpoint)
+    assert [row['lottery_round'] for row in rows] == ['2', '2']
@@ -0,0 +1,51 @@
+import pytest
+from sqlalchemy import insert
+
+from lottery.history import history_page, group_by_round
+from models import Draw, ArchivedDraw
+
+
+# 23 played draws of user 1 over rounds 1 to 3, added out of round order so ids and rounds disagree
+@pytest.fixture
+def draws(database):
+    rows = [{'user_id': 1, 'numbers': b'cipher', 'numbers_digest': None, 'been_played': True, 'matches_master': False,
+             'prize_tier': 0, 'master_draw': False, 'lottery_round': (n * 7) % 3 + 1, 'envelope': False}
+            for n in range(23)]
+    database.session.execute(insert(Draw), rows)
+    database.session.execute(insert(ArchivedDraw), rows)
+    database.session.commit()
+
+
+def cursor(draw):
+    return draw.lottery_round, draw.id
+
+
+@pytest.mark.parametrize('model', [Draw, ArchivedDraw])
+def test_history_pages_walk_every_draw_once_newest_first(draws, model):
+    expected = [(draw.lottery_round, draw.id) for draw in
+                model.query.filter_by(user_id=1).order_by(model.lottery_round.desc(), model.id.desc())]
+
+    pages = []
+    page, more = history_page(1, True, 5, model=model)
+    pages.append(page)
+    while more:
+        page, more = history_page(1, True, 5, after=cursor(page[-1]), model=model)
+        pages.append(page)
+
+    assert [len(page) for page in pages] == [5, 5, 5, 5, 3]
+    assert [cursor(draw) for page in pages for draw in page] == expected
+
+    # going back from each page returns the page before it
+    for previous, page in zip(pages, pages[1:]):
+        back, _ = history_page(1, True, 5, before=cursor(page[0]), model=model)
+        assert [cursor(draw) for draw in back] == [cursor(draw) for draw in previous]
+
+
+def test_history_of_other_users_and_unplayed_draws_is_empty(draws):
+    assert history_page(2, True, 5) == ([], False)
+    assert history_page(1, False, 5) == ([], False)
+
+
+def test_pages_are_grouped_by_round_in_page_order():
+    draws = [{'lottery_round': 3, 'id': 9}, {'lottery_round': 3, 'id': 4}, {'lottery_round': 1, 'id': 7}]
+    assert group_by_round(draws) == [(3, draws[:2]), (1, draws[2:])]
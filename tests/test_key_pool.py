@@ -0,0 +1,28 @@
+import time
+
+import app as app_module
+from app import app
+from key_pool import KeyPairPool
+
+
+def test_empty_pool_generates_inline():
+    pool = KeyPairPool(low=0, high=0, bits=256)
+    public_key, private_key = pool.take()
+
+    assert public_key.n == private_key.n
+    assert pool.stats()['fallbacks'] == 1
+
+
+def test_pool_is_filled_from_the_first_request(monkeypatch):
+    pool = KeyPairPool(low=1, high=2, bits=256)
+    monkeypatch.setattr(app_module, 'key_pool', pool)
+    assert pool.stats()['generated'] == 0
+
+    app.test_client().get('/', base_url='https://localhost')
+    deadline = time.monotonic() + 10
+    while pool.stats()['depth'] < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert pool.stats()['depth'] == 2
+    pool.take()
+    assert pool.stats()['taken'] == 1
@@ -0,0 +1,57 @@
+import os
+
+from admin.log_reader import read_page
+
+
+# Writes lines numbered first to last, oldest first, to each file. Older files get older modification times
+def write_logs(tmp_path, files):
+    for age, (name, first, last) in enumerate(files):
+        path = tmp_path / name
+        path.write_text(''.join('line %d\n' % number for number in range(first, last + 1)))
+        os.utime(path, (1000 - age, 1000 - age))
+    return str(tmp_path / files[0][0])
+
+
+def walk(path, count):
+    pages = []
+    page, cursor = read_page(path, count)
+    pages.append(page)
+    while cursor is not None:
+        page, cursor = read_page(path, count, cursor)
+        pages.append(page)
+    return pages
+
+
+def test_pages_continue_into_rotated_files(tmp_path):
+    path = write_logs(tmp_path, [('lottery.log', 8, 10), ('lottery.log.1', 4, 7), ('lottery.log.2', 1, 3)])
+
+    pages = walk(path, 4)
+
+    assert pages[0] == ['line 10', 'line 9', 'line 8', 'line 7']
+    assert [line for page in pages for line in page] == ['line %d' % number for number in range(10, 0, -1)]
+
+
+def test_cursor_follows_its_file_through_a_rotation(tmp_path):
+    path = write_logs(tmp_path, [('lottery.log', 5, 10), ('lottery.log.1', 1, 4)])
+    page, cursor = read_page(path, 3)
+    assert page == ['line 10', 'line 9', 'line 8']
+
+    # the active file is rotated and new entries are written before the next page is read
+    os.rename(tmp_path / 'lottery.log.1', tmp_path / 'lottery.log.2')
+    os.rename(path, tmp_path / 'lottery.log.1')
+    write_logs(tmp_path, [('lottery.log', 11, 12)])
+
+    page, cursor = read_page(path, 3, cursor)
+    assert page == ['line 7', 'line 6', 'line 5']
+    page, cursor = read_page(path, 3, cursor)
+    assert page == ['line 4', 'line 3', 'line 2']
+
+
+def test_long_lines_are_read_across_blocks(tmp_path):
+    path = tmp_path / 'lottery.log'
+    path.write_text('a' * 20000 + '\n' + 'b' * 10 + '\n')
+
+    page, cursor = read_page(str(path), 5)
+
+    assert page == ['b' * 10, 'a' * 20000]
+    assert cursor is None
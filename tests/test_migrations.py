@@ -0,0 +1,53 @@
+from sqlalchemy import insert
+
+import json
+
+from migrations import autoincrement_draw_ids, backfill_jackpot_tiers, materialize_played_rounds
+from models import Draw, ArchivedDraw, RoundJob, RoundResult, RoundOutcome
+
+
+def draw_row(matches_master, master_draw=False, prize_tier=0, lottery_round=1, user_id=1):
+    return {'user_id': user_id, 'numbers': b'cipher', 'numbers_digest': None, 'been_played': True,
+            'matches_master': matches_master, 'prize_tier': prize_tier, 'master_draw': master_draw,
+            'lottery_round': lottery_round, 'envelope': False}
+
+
+def test_legacy_winners_get_the_jackpot_tier(database):
+    rows = [draw_row(True), draw_row(False), draw_row(False, master_draw=True), draw_row(True, prize_tier=4)]
+    database.session.execute(insert(Draw), rows)
+    database.session.execute(insert(ArchivedDraw), rows)
+    database.session.commit()
+
+    backfill_jackpot_tiers()
+
+    for model in (Draw, ArchivedDraw):
+        assert [draw.prize_tier for draw in model.query.order_by(model.id)] == [6, 0, 0, 4]
+
+
+def test_rebuilt_draws_table_skips_the_ids_of_round_jobs(database):
+    database.session.execute(insert(Draw), [draw_row(False), draw_row(False, master_draw=True)])
+    database.session.add(RoundJob(lottery_round=1, master_draw_id=2, started_by=1, max_draw_id=9, total=1))
+    database.session.commit()
+
+    autoincrement_draw_ids()
+
+    assert [draw.master_draw for draw in Draw.query.order_by(Draw.id)] == [False, True]
+    database.session.execute(insert(Draw), [draw_row(False)])
+    assert database.session.query(database.func.max(Draw.id)).scalar() == 10
+
+
+# rounds played before round jobs existed: round 1 archived without its master draw, round 2 still live
+def test_rounds_played_without_a_job_get_their_results(database):
+    database.session.execute(insert(ArchivedDraw), [draw_row(True, prize_tier=6), draw_row(False, user_id=2)])
+    database.session.execute(insert(Draw), [draw_row(False, lottery_round=2), draw_row(False, lottery_round=2),
+                                            draw_row(False, master_draw=True, lottery_round=2)])
+    database.session.commit()
+
+    materialize_played_rounds()
+
+    results = {result.lottery_round: result for result in RoundResult.query}
+    assert (results[1].master_draw_id, results[1].total_draws) == (0, 2)
+    assert json.loads(results[1].tier_counts)['6'] == 1
+    assert (results[2].master_draw_id, results[2].total_draws) == (3, 2)
+    assert {(outcome.user_id, outcome.lottery_round, outcome.draws, outcome.winning_draws, outcome.best_tier)
+            for outcome in RoundOutcome.query} == {(1, 1, 1, 1, 6), (2, 1, 1, 0, 0), (1, 2, 2, 0, 0)}
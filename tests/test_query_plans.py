@@ -0,0 +1,48 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import insert
+
+from models import User, Draw, ArchivedDraw
+from migrations import hot_queries, unbounded_steps
+
+
+# Bulk inserts users and draws without encrypting anything, only the indexed columns matter to the query planner
+def seed(db, users=2000, draws_per_user=5, rounds=4):
+    user_rows = [{'email': 'user%05d@email.com' % i, 'firstname': 'First', 'lastname': 'Last%05d' % i,
+                  'birthdate': '01/01/1999', 'postcode': 'NE%d 5SA' % (i % 10), 'phone': '0191-123-4567',
+                  'password': b'hash', 'role': 'user', 'key_version': 1, 'public_key': b'key', 'private_key': b'key',
+                  'registered_on': datetime(2024, 1, 1),
+                  'total_logins': 0}
+                 for i in range(users)]
+    db.session.execute(insert(User), user_rows)
+    user_ids = [user.id for user in db.session.query(User.id).filter(User.role == 'user')]
+
+    draw_rows = [{'user_id': user_id, 'numbers': b'cipher', 'numbers_digest': '%064d' % (user_id * 10 + n),
+                  'been_played': n % 2 == 0, 'matches_master': n == 0, 'prize_tier': 0, 'master_draw': False,
+                  'lottery_round': n % rounds, 'envelope': False}
+                 for user_id in user_ids for n in range(draws_per_user)]
+    # the admin's winning draws, one per round
+    master_rows = [{'user_id': 1, 'numbers': b'cipher', 'numbers_digest': '%064d' % lottery_round,
+                    'been_played': lottery_round < rounds, 'matches_master': False, 'prize_tier': 0,
+                    'master_draw': True, 'lottery_round': lottery_round, 'envelope': False}
+                   for lottery_round in range(1, rounds + 1)]
+    db.session.execute(insert(Draw), draw_rows + master_rows[-1:])
+    db.session.execute(insert(ArchivedDraw), draw_rows + master_rows[:-1])
+    db.session.commit()
+
+
+@pytest.mark.parametrize('analyze', [False, True])
+def test_hot_queries_read_index_ranges(database, analyze):
+    seed(database)
+    if analyze:
+        # with statistics the planner may choose other indexes, the hot queries must still be index ranges
+        database.session.execute(database.text('ANALYZE'))
+
+    plans = {name: unbounded_steps(query) for name, query in hot_queries().items()}
+    assert {name: steps for name, steps in plans.items() if steps} == {}
+
+
+def test_full_scans_and_sorts_are_detected(database):
+    assert unbounded_steps(Draw.query.filter(Draw.numbers == b'cipher'))
+    assert unbounded_steps(User.query.filter(User.role == 'user').order_by(User.phone))
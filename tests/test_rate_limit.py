@@ -0,0 +1,75 @@
+import pytest
+
+import rate_limit
+from app import app
+from models import User
+from rate_limit import TokenBucketLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit.time, 'monotonic', clock)
+    return clock
+
+
+def test_burst_then_refill(clock):
+    limiter = TokenBucketLimiter(rate=1, burst=3, max_buckets=10)
+
+    assert [limiter.allow('a') for _ in range(4)] == [True, True, True, False]
+    clock.now += 1
+    assert [limiter.allow('a') for _ in range(2)] == [True, False]
+    # other keys have their own bucket
+    assert limiter.allow('b')
+    assert limiter.stats()['rejected'] == 2
+
+
+def test_refilled_buckets_are_dropped(clock):
+    limiter = TokenBucketLimiter(rate=1, burst=2, max_buckets=10)
+    for key in range(5):
+        limiter.allow(key)
+
+    clock.now += 2
+    limiter.allow('new')
+    assert limiter.stats()['buckets'] == 1
+    assert limiter.stats()['evicted'] == 0
+
+
+def test_bucket_count_is_bounded(clock):
+    limiter = TokenBucketLimiter(rate=1, burst=2, max_buckets=3)
+    for key in range(10):
+        limiter.allow(key)
+
+    assert limiter.stats()['buckets'] == 3
+    assert limiter.stats()['evicted'] == 7
+
+
+def test_refused_ip_does_not_use_email_tokens(clock, monkeypatch):
+    monkeypatch.setattr(rate_limit, 'login_ip_limiter', TokenBucketLimiter(rate=1, burst=1, max_buckets=10))
+    monkeypatch.setattr(rate_limit, 'login_email_limiter', TokenBucketLimiter(rate=1, burst=2, max_buckets=10))
+
+    assert rate_limit.login_allowed('10.0.0.1', 'User@Email.com ')
+    assert not rate_limit.login_allowed('10.0.0.1', 'user@email.com')
+    # the email bucket still has a token, shared whatever the case and spacing of the address
+    assert rate_limit.login_allowed('10.0.0.2', 'user@email.com')
+    assert not rate_limit.login_allowed('10.0.0.3', 'USER@email.com')
+
+
+def test_login_is_refused_before_the_user_is_looked_up(database, clock, monkeypatch):
+    monkeypatch.setattr(rate_limit, 'login_ip_limiter', TokenBucketLimiter(rate=1, burst=2, max_buckets=10))
+    monkeypatch.setattr(rate_limit, 'login_email_limiter', TokenBucketLimiter(rate=1, burst=10, max_buckets=10))
+    monkeypatch.setattr(User, 'verify_password', lambda user, password: pytest.fail('password checked'))
+
+    client = app.test_client()
+    data = {'email': 'admin@email.com', 'password': 'wrong', 'pin': '123456', 'postcode': 'NE4 5SA'}
+    codes = [client.post('/login', data=data, base_url='https://localhost').status_code for _ in range(3)]
+    assert codes[-1] == 429
+
@@ -0,0 +1,57 @@
+from datetime import datetime
+
+from models import RoundResult
+from round_results import ResultsCache
+
+
+def add_result(database, lottery_round):
+    database.session.add(RoundResult(lottery_round=lottery_round, master_draw_id=0, total_draws=0, tier_counts='{}',
+                                     created_at=datetime.now()))
+    database.session.commit()
+
+
+def test_cached_values_are_dropped_when_a_new_round_has_results(database):
+    cache = ResultsCache(10, version_ttl=0)
+    add_result(database, 1)
+    assert cache.get('key', lambda: 'round 1') == 'round 1'
+    assert cache.get('key', lambda: 'reloaded') == 'round 1'
+
+    add_result(database, 2)
+    assert cache.get('key', lambda: 'round 2') == 'round 2'
+    assert cache.stats()['version'] == 2
+
+
+def test_version_is_only_reread_after_its_ttl(database):
+    cache = ResultsCache(10, version_ttl=60)
+    add_result(database, 1)
+    cache.get('key', lambda: 'round 1')
+
+    add_result(database, 2)
+    assert cache.get('key', lambda: 'round 2') == 'round 1'
+
+    # the process that finished the round moves its cache at once
+    cache.set_version(2)
+    assert cache.get('key', lambda: 'round 2') == 'round 2'
+
+
+def test_value_loaded_across_a_version_change_is_not_kept(database):
+    cache = ResultsCache(10, version_ttl=60)
+    cache.set_version(1)
+
+    def load():
+        cache.set_version(2)
+        return 'round 1'
+    assert cache.get('key', load) == 'round 1'
+    assert cache.get('key', lambda: 'round 2') == 'round 2'
+
+
+def test_least_recently_used_entries_are_evicted(database):
+    cache = ResultsCache(2, version_ttl=60)
+    cache.set_version(1)
+    cache.get('a', lambda: 1)
+    cache.get('b', lambda: 2)
+    cache.get('a', lambda: None)
+    cache.get('c', lambda: 3)
+
+    assert cache.get('a', lambda: None) == 1
+    assert cache.get('b', lambda: 'reloaded') == 'reloaded'
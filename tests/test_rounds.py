@@ -0,0 +1,202 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+import rsa
+
+import key_cache
+from admin import rounds
+from app import app, db
+from lottery.tickets import submit_tickets
+from models import User, Draw, RoundJob, RoundOutcome, numbers_digest
+
+
+def add_user(db, email, role='user'):
+    public_key, private_key = rsa.newkeys(512)
+    user = User(email=email, firstname='First', lastname='Last', birthdate='01/01/1999', postcode='NE4 5SA',
+                phone='0191-123-4567', password='Pass1!', role=role, public_key=public_key, private_key=private_key)
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+# Runs round 1 with winning numbers 1 2 3 4 5 6 in the calling thread. user1 has a jackpot, a 3 match and a loser,
+# user2 a 4 match, user3 plays nothing
+@pytest.fixture
+def played_round(database, monkeypatch):
+    monkeypatch.setattr(rounds, 'start_job_thread', rounds.run_job)
+    admin = User.query.filter_by(role='admin').first()
+    user1 = add_user(database, 'user1@email.com')
+    user2 = add_user(database, 'user2@email.com')
+    add_user(database, 'user3@email.com')
+    submit_tickets(user1, [[1, 2, 3, 4, 5, 6], [1, 2, 3, 10, 11, 12], [20, 21, 22, 23, 24, 25]])
+    submit_tickets(user2, [[6, 5, 4, 3, 40, 41]])
+
+    def play():
+        master = Draw(user_id=admin.id, numbers='1 2 3 4 5 6', master_draw=True, lottery_round=1,
+                      public_key=key_cache.public_key(admin))
+        database.session.add(master)
+        database.session.commit()
+        job = rounds.start_round(master, admin.id)
+        database.session.expire_all()
+        return database.session.get(RoundJob, job.id), user1, user2
+    return play
+
+
+def test_round_scores_every_draw_by_prize_tier(played_round):
+    job, user1, user2 = played_round()
+
+    assert job.status == 'finished'
+    assert job.processed == 4
+    assert json.loads(job.tier_counts) == {'3': 1, '4': 1, '5': 0, '6': 1}
+    assert Draw.query.filter_by(master_draw=False, been_played=False).count() == 0
+
+    winners = sorted((numbers, user_id, tier) for _, numbers, user_id, _, tier in rounds.winning_results(1))
+    assert winners == [('1 2 3 10 11 12', user1.id, 3), ('1 2 3 4 5 6', user1.id, 6),
+                       ('6 5 4 3 40 41', user2.id, 4)]
+
+    outcomes = {(outcome.user_id, outcome.draws, outcome.winning_draws, outcome.best_tier)
+                for outcome in RoundOutcome.query.filter_by(lottery_round=1)}
+    assert outcomes == {(user1.id, 3, 2, 6), (user2.id, 1, 1, 4)}
+
+
+def test_jackpot_only_round_uses_the_blind_index(played_round, monkeypatch):
+    monkeypatch.setitem(app.config, 'PRIZE_TIERS', [6])
+    job, user1, _ = played_round()
+
+    assert json.loads(job.tier_counts) == {'6': 1}
+    winners = [(numbers, user_id) for _, numbers, user_id, _, _ in rounds.winning_results(1)]
+    assert winners == [('1 2 3 4 5 6', user1.id)]
+
+
+def test_round_checkpoints_every_chunk(played_round, monkeypatch):
+    monkeypatch.setitem(app.config, 'ROUND_CHUNK_SIZE', 1)
+    job, _, _ = played_round()
+
+    assert job.status == 'finished'
+    assert job.processed == 4
+    assert job.last_draw_id == job.max_draw_id
+    assert Draw.query.filter_by(master_draw=False, been_played=False).count() == 0
+    assert json.loads(job.tier_counts) == {'3': 1, '4': 1, '5': 0, '6': 1}
+
+
+def test_parallel_matching_finds_the_same_winners(played_round, monkeypatch):
+    monkeypatch.setitem(app.config, 'ROUND_WORKERS', 2)
+    monkeypatch.setitem(app.config, 'ROUND_PARALLEL_MIN_DRAWS', 1)
+    monkeypatch.setitem(app.config, 'ROUND_WORKER_CHUNK_SIZE', 1)
+    job, _, _ = played_round()
+
+    assert job.status == 'finished'
+    assert json.loads(job.tier_counts) == {'3': 1, '4': 1, '5': 0, '6': 1}
+
+
+def test_blind_index_ignores_the_order_of_the_numbers(database):
+    assert numbers_digest('6 5 4 3 2 1') == numbers_digest('1 2 3 4 5 6')
+    assert numbers_digest('1 2 3 4 5 7') != numbers_digest('1 2 3 4 5 6')
+
+
+def test_prize_tier_is_the_highest_tier_matched(monkeypatch):
+    monkeypatch.setitem(app.config, 'PRIZE_TIERS', [3, 5, 6])
+    assert [rounds.prize_tier(matches) for matches in range(7)] == [0, 0, 0, 3, 3, 5, 6]
+
+
+# Makes the round fail once the given number of chunks have been committed, as a worker that hits a bad draw would
+def fail_after(monkeypatch, chunks):
+    apply_chunk = rounds.apply_chunk
+    applied = []
+
+    def failing_apply_chunk(*args):
+        if len(applied) == chunks:
+            raise ValueError('draw will not decrypt')
+        applied.append(args[0])
+        apply_chunk(*args)
+    monkeypatch.setattr(rounds, 'apply_chunk', failing_apply_chunk)
+    return lambda: monkeypatch.setattr(rounds, 'apply_chunk', apply_chunk)
+
+
+def test_failed_round_resumes_from_its_checkpoint(played_round, monkeypatch):
+    monkeypatch.setitem(app.config, 'ROUND_CHUNK_SIZE', 1)
+    repair = fail_after(monkeypatch, 2)
+    job, _, _ = played_round()
+
+    assert job.status == 'failed'
+    assert job.processed == 2
+    assert Draw.query.filter_by(master_draw=False, been_played=True).count() == 2
+
+    repair()
+    assert rounds.job_is_stalled(job)
+    assert rounds.resume_round(job)
+    db.session.refresh(job)
+    assert job.status == 'finished'
+    assert job.processed == 4
+    assert json.loads(job.tier_counts) == {'3': 1, '4': 1, '5': 0, '6': 1}
+
+
+def test_round_is_started_and_resumed_only_once(played_round, monkeypatch):
+    repair = fail_after(monkeypatch, 0)
+    job, _, _ = played_round()
+    repair()
+
+    # even a request that wins the claim on the master draw can not create a second job for the round
+    master = db.session.get(Draw, job.master_draw_id)
+    master.been_played = False
+    assert rounds.start_round(master, job.started_by) is None
+
+    started = []
+    monkeypatch.setattr(rounds, 'start_job_thread', started.append)
+    # the job as a second admin's request loaded it
+    stale = SimpleNamespace(id=job.id, status=job.status, updated_at=job.updated_at)
+    assert rounds.resume_round(job)
+    # a second admin resuming from the same page loses the claim
+    assert not rounds.resume_round(stale)
+    assert started == [job.id]
+
+
+def test_abandoned_round_keeps_the_draws_played(played_round, monkeypatch):
+    monkeypatch.setitem(app.config, 'ROUND_CHUNK_SIZE', 1)
+    fail_after(monkeypatch, 1)
+    job, user1, _ = played_round()
+
+    assert rounds.abandon_job(job)
+    job = db.session.get(RoundJob, job.id)
+    assert job.status == 'abandoned'
+    assert not rounds.job_is_stalled(job)
+
+    # the first draw played and has its outcome, the rest wait for the next round
+    assert {(outcome.user_id, outcome.draws) for outcome in RoundOutcome.query} == {(user1.id, 1)}
+    assert Draw.query.filter_by(master_draw=False, been_played=False, lottery_round=0).count() == 3
+    assert rounds.close_rounds(1) == 2
+
+
+def test_closed_round_keeps_its_winners(played_round):
+    played_round()
+    rounds.close_rounds(1)
+
+    assert Draw.query.filter_by(lottery_round=1).count() == 0
+    assert len(rounds.winning_results(1)) == 3
+    assert rounds.archived_master_numbers(1) == '1 2 3 4 5 6'
+    assert rounds.next_round_number() == 2
+
+
+def test_archived_draw_ids_are_not_handed_out_again(played_round):
+    job, user1, _ = played_round()
+    rounds.close_rounds(1)
+
+    submit_tickets(user1, [[7, 8, 9, 10, 11, 12]])
+    assert Draw.query.one().id > job.max_draw_id
+
+
+def test_played_draws_of_a_closed_round_are_read_from_the_archive(played_round, monkeypatch):
+    monkeypatch.setitem(app.config, 'WTF_CSRF_ENABLED', False)
+    _, user1, _ = played_round()
+    rounds.close_rounds(1)
+
+    client = app.test_client()
+    with client.session_transaction(base_url='https://localhost') as session:
+        session['_user_id'] = str(user1.id)
+        session['_fresh'] = True
+    page = client.post('/check_draws', data={'page': 1}, base_url='https://localhost').get_data(as_text=True)
+
+    assert 'Round 1: 2 of your' in page
+    for numbers in ('1 2 3 4 5 6', '1 2 3 10 11 12', '20 21 22 23 24 25'):
+        assert numbers in page
@@ -0,0 +1,59 @@
+import logging
+from datetime import datetime
+
+from security_events import SecurityEventHandler, search, security_event
+
+
+def record(message, created, **fields):
+    return logging.makeLogRecord(dict(security_event(**fields), msg=message, created=created.timestamp()))
+
+
+def store(tmp_path):
+    path = str(tmp_path / 'events.db')
+    handler = SecurityEventHandler(path)
+    # event n is a login on odd n, by user n % 4 from ip n % 2 on the (n % 3 + 1)th of January
+    handler.emit_batch([record('login %d' % n, datetime(2024, 1, 1 + n % 3, 12),
+                               event='login' if n % 2 else 'failed_login', user_id=n % 4,
+                               email='user%d@email.com' % (n % 4), ip='10.0.0.%d' % (n % 2))
+                        for n in range(12)])
+    # records logged without a security event are not stored
+    handler.emit_batch([logging.makeLogRecord({'msg': 'plain'})])
+    return path
+
+
+def test_filters_are_combined(tmp_path):
+    path = store(tmp_path)
+
+    events, _ = search(path, {'event': 'login', 'ip': '10.0.0.1'})
+    assert [event['message'] for event in events] == ['login %d' % n for n in (11, 9, 7, 5, 3, 1)]
+
+    events, _ = search(path, {'user_id': 1, 'since': '2024-01-02 00:00:00', 'until': '2024-01-02 23:59:59'})
+    assert [event['message'] for event in events] == ['login 1']
+    assert search(path, {'email': 'user2@email.com'})[0][0]['message'] == 'login 10'
+
+
+def test_pages_continue_before_the_cursor(tmp_path):
+    path = store(tmp_path)
+
+    pages = []
+    events, before = search(path, {}, limit=5)
+    pages.append(events)
+    while before is not None:
+        events, before = search(path, {}, before, limit=5)
+        pages.append(events)
+
+    assert [len(page) for page in pages] == [5, 5, 2]
+    assert [event['message'] for page in pages for event in page] == ['login %d' % n for n in range(11, -1, -1)]
+
+
+def test_nothing_logged_yet(tmp_path):
+    assert search(str(tmp_path / 'missing.db'), {}) == ([], None)
+    assert not (tmp_path / 'missing.db').exists()
+
+
+def test_failed_batches_are_counted(tmp_path):
+    handler = SecurityEventHandler(str(tmp_path / 'missing' / 'events.db'))
+    handler.emit_batch([record('login', datetime(2024, 1, 1), event='login')])
+
+    assert handler.failed == 1
+    assert 'OperationalError' in handler.last_error
@@ -0,0 +1,58 @@
+import pytest
+
+from app import app
+from lottery.tickets import parse_tickets, quick_pick
+from models import Draw
+
+
+def test_tickets_are_parsed_one_per_line():
+    tickets, errors = parse_tickets('1 2 3 4 5 6\n\n 7, 8,9 10 11 60 \n')
+
+    assert tickets == [[1, 2, 3, 4, 5, 6], [7, 8, 9, 10, 11, 60]]
+    assert errors == []
+
+
+def test_every_bad_line_is_reported():
+    tickets, errors = parse_tickets('1 2 3 4 5\n1 2 3 4 5 61\n1 1 2 3 4 5\n1 2 x 4 5 6\n1 2 3 4 5 6')
+
+    assert tickets == [[1, 2, 3, 4, 5, 6]]
+    assert errors == ['Line 1: draw must contain 6 numbers',
+                      'Line 2: draw numbers must be in between 1 and 60',
+                      'Line 3: draw numbers must be unique',
+                      'Line 4: draw numbers must be whole numbers']
+
+
+def test_quick_picks_are_valid_draws():
+    for _ in range(100):
+        numbers = quick_pick()
+        assert numbers == sorted(set(numbers))
+        assert len(numbers) == 6 and 1 <= numbers[0] and numbers[-1] <= 60
+
+
+@pytest.fixture
+def client(database, monkeypatch):
+    monkeypatch.setitem(app.config, 'WTF_CSRF_ENABLED', False)
+    monkeypatch.setitem(app.config, 'MAX_BULK_TICKETS', 3)
+    client = app.test_client()
+    with client.session_transaction(base_url='https://localhost') as session:
+        session['_user_id'] = '1'
+        session['_fresh'] = True
+
+    def submit(tickets='', quick_picks=''):
+        response = client.post('/bulk_draws', data={'tickets': tickets, 'quick_picks': quick_picks},
+                               base_url='https://localhost', follow_redirects=True)
+        return response.get_data(as_text=True)
+    return submit
+
+
+def test_bulk_submission_stores_typed_draws_and_lucky_dips(client):
+    page = client('1 2 3 4 5 6', 2)
+
+    assert '3 draws submitted.' in page
+    assert Draw.query.filter_by(user_id=1, master_draw=False).count() == 3
+
+
+def test_bulk_submission_is_capped(client):
+    assert 'At most 3 draws can be submitted at once' in client('1 2 3 4 5 6\n7 8 9 10 11 12', 2)
+    assert 'At most 3 draws can be submitted at once' in client(quick_picks=1000000)
+    assert Draw.query.count() == 0
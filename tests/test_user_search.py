@@ -0,0 +1,60 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import insert
+
+from admin.user_search import user_page, approximate_count, prefix_upper_bound
+from models import User
+
+
+# 18 users, three of each surname, with emails in mixed case
+@pytest.fixture
+def users(database):
+    lastnames = ['Smith', 'Smyth', 'Jones', 'Smithson', 'Brown', 'smit'] * 3
+    database.session.execute(insert(User), [
+        {'email': '%s%02d@Email.com' % ('User' if i % 2 else 'user', i), 'firstname': 'First', 'lastname': lastname,
+         'birthdate': '01/01/1999', 'postcode': 'NE%d 5SA' % (i % 3), 'phone': '0191-123-4567', 'password': b'hash',
+         'role': 'user', 'key_version': 1, 'public_key': b'key', 'private_key': b'key', 'total_logins': 0,
+         'registered_on': datetime(2024, 1, 1)}
+        for i, lastname in enumerate(lastnames)])
+    database.session.commit()
+
+
+def walk_users(page_size, field=None, prefix=''):
+    pages = []
+    after, after_value = 0, None
+    while True:
+        page, more = user_page(page_size, field, prefix, after, after_value)
+        pages.append(page)
+        if not more:
+            return pages
+        after = page[-1].id
+        after_value = getattr(page[-1], field) if field else None
+
+
+def test_user_list_pages_by_id_without_admins(users):
+    pages = walk_users(4)
+
+    ids = [user.id for page in pages for user in page]
+    assert ids == sorted(ids)
+    assert len(ids) == 18
+    assert 'admin@email.com' not in [user.email for page in pages for user in page]
+
+
+def test_user_search_pages_by_prefix_whatever_the_case(users):
+    pages = walk_users(4, 'lastname', 'SMI')
+
+    found = [(user.lastname.lower(), user.id) for page in pages for user in page]
+    assert found == sorted(found)
+    assert [lastname for lastname, _ in found] == ['smit'] * 3 + ['smith'] * 3 + ['smithson'] * 3
+    assert approximate_count('lastname', 'smi') == (9, True)
+
+
+def test_email_and_postcode_search(users):
+    assert len([user for page in walk_users(5, 'email', 'USER0') for user in page]) == 10
+    assert [user.postcode for user in user_page(50, 'postcode', 'ne1')[0]] == ['NE1 5SA'] * 6
+
+
+def test_prefix_upper_bound():
+    assert prefix_upper_bound('Smi') == 'Smj'
+    assert 'Smith' < prefix_upper_bound('Smi') <= 'Smj'
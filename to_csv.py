@@ -1,22 +1,164 @@
+import argparse
 import csv
-from sqlalchemy import create_engine, MetaData, Table
-
-# connects to engine given database URI
-engine = create_engine('sqlite:///instance/lottery.db')
-connection = engine.connect()
-# Used to see what tables are in the database
-metadata = MetaData()
-metadata.reflect(engine)
-print(metadata.tables.keys())
-# Selects desired table by name and stores it into the variable
-table = Table('users', metadata, autoload=True, autoload_with=engine)
-
-query = connection.execute(table.select())
-rows = query.fetchall()
-with open('table.csv', 'w', newline='') as csvfile:
-    csv_writer = csv.writer(csvfile)
-    # Write header
-    csv_writer.writerow([column.name for column in table.columns])
-    # Write rows
-    csv_writer.writerows(rows)
-connection.close()
+import gzip
+import json
+import os
+import sys
+import warnings
+from sqlalchemy import create_engine, MetaData, select, union_all
+
+# Exports tables of the lottery database to CSV, streaming rows in fixed-size batches so memory use does not
+# depend on table size.
+#   python to_csv.py                            users table to users.csv
+#   python to_csv.py --tables all --gzip        every table and the per-round results, gzip compressed
+#   python to_csv.py --tables draws --incremental
+#                                               only draws added or changed since the last incremental export
+
+# the per-round results export, not a table: played user draws of open and closed rounds without their encrypted
+# numbers
+RESULTS = 'results'
+
+# change counter of the tables whose rows are updated, raised by every insert and update. Their incremental exports
+# resume from it, so a changed row is exported again (deleted rows are not, draws of closed rounds reappear in
+# draws_archive). Tables without one are only ever inserted into and resume from their primary key
+CHANGE_COLUMN = 'change_seq'
+
+# resume columns of tables whose primary key has several columns. Round outcomes are all written when their round
+# finishes, so they resume from the round. Other such tables can only be exported in full
+RESUME_COLUMNS = {'round_outcomes': 'lottery_round'}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export lottery database tables to CSV.')
+    parser.add_argument('--database', default='sqlite:///instance/lottery.db', help='database URI')
+    parser.add_argument('--tables', nargs='+', default=['users'],
+                        help="tables to export, '%s' for per-round results or 'all'" % RESULTS)
+    parser.add_argument('--output-dir', default='.', help='directory to write the CSV files to')
+    parser.add_argument('--batch-size', type=int, default=5000, help='rows fetched from the database at a time')
+    parser.add_argument('--gzip', action='store_true', help='write gzip compressed .csv.gz files')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only export rows added since the last incremental export')
+    parser.add_argument('--checkpoint', default='export_checkpoint.json',
+                        help='file recording where each incremental export stopped')
+    return parser.parse_args()
+
+
+# Select statement and the column its incremental export resumes from (None if it can not be resumed).
+# Tables resume from their change counter or primary key, results from the lottery round so a round is always
+# exported whole
+def export_query(metadata, name):
+    if name == RESULTS:
+        # played draws of the current round are in draws, those of closed rounds in draws_archive
+        played = []
+        for table_name in ('draws', 'draws_archive'):
+            if table_name not in metadata.tables:
+                continue
+            draws = metadata.tables[table_name]
+            columns = [draws.c.lottery_round, draws.c.id, draws.c.user_id, draws.c.matches_master]
+            if 'prize_tier' in draws.c:
+                columns.append(draws.c.prize_tier)
+            query = select(*columns).where(draws.c.master_draw.is_(False), draws.c.been_played.is_(True))
+            if table_name == 'draws' and 'round_results' in metadata.tables:
+                # a round's results are written when its last draw has been played, rounds still being played are
+                # left for a later export
+                query = query.where(draws.c.lottery_round.in_(select(metadata.tables['round_results'].c.lottery_round)))
+            played.append(query)
+        results = union_all(*played).subquery() if len(played) > 1 else played[0].subquery()
+        return select(results), results.c.lottery_round
+
+    table = metadata.tables[name]
+    if CHANGE_COLUMN in table.c:
+        return select(table), table.c[CHANGE_COLUMN]
+    if name in RESUME_COLUMNS:
+        return select(table), table.c[RESUME_COLUMNS[name]]
+    if len(table.primary_key.columns) != 1:
+        return select(table), None
+    return select(table), list(table.primary_key.columns)[0]
+
+
+# Tables of the database. Only their columns are needed, the expression indexes SQLAlchemy can not reflect (the
+# user search indexes on lower(...)) are skipped without a warning
+def reflect(engine):
+    metadata = MetaData()
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', 'Skipped unsupported reflection of expression-based index')
+        metadata.reflect(engine)
+    return metadata
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def save_checkpoint(path, checkpoint):
+    with open(path, 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file, indent=2)
+
+
+# Writes one table to CSV and returns (rows written, highest value of the resume column)
+def export(connection, metadata, name, args, since=None):
+    query, resume_column = export_query(metadata, name)
+    if since is not None:
+        query = query.where(resume_column > since)
+    if resume_column is not None:
+        query = query.order_by(resume_column)
+
+    path = os.path.join(args.output_dir, name + '.csv' + ('.gz' if args.gzip else ''))
+    opener = gzip.open if args.gzip else open
+
+    # server side cursor, rows are fetched batch_size at a time instead of all at once
+    result = connection.execution_options(stream_results=True, yield_per=args.batch_size).execute(query)
+    resume_index = list(result.keys()).index(resume_column.name) if resume_column is not None else None
+
+    rows = 0
+    highest = since
+    with opener(path, 'wt', newline='') as csvfile:
+        csv_writer = csv.writer(csvfile)
+        # Write header
+        csv_writer.writerow(result.keys())
+        # Write rows, one batch at a time
+        for batch in result.partitions():
+            csv_writer.writerows(batch)
+            rows += len(batch)
+            if resume_index is not None:
+                highest = batch[-1][resume_index]
+    return rows, highest
+
+
+def main():
+    args = parse_args()
+
+    # connects to engine given database URI
+    engine = create_engine(args.database)
+    # Used to see what tables are in the database
+    metadata = reflect(engine)
+
+    names = args.tables
+    if 'all' in names:
+        names = list(metadata.tables) + [RESULTS]
+
+    if args.incremental:
+        # refused before anything is written, only a change counter, a single column key or a RESUME_COLUMNS entry
+        # is a high-water mark
+        unresumable = [name for name in names if export_query(metadata, name)[1] is None]
+        if unresumable:
+            sys.exit('Can not export incrementally, no change counter or single column primary key: %s' % ', '.join(unresumable))
+
+    checkpoint = load_checkpoint(args.checkpoint) if args.incremental else {}
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    with engine.connect() as connection:
+        for name in names:
+            rows, highest = export(connection, metadata, name, args, checkpoint.get(name))
+            print('%s: %d rows' % (name, rows))
+            if args.incremental and highest is not None:
+                checkpoint[name] = highest
+                # saved after every table so a failed export only repeats the table it failed on
+                save_checkpoint(args.checkpoint, checkpoint)
+
+
+if __name__ == '__main__':
+    main()
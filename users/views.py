@@ -3,11 +3,13 @@ from flask import Blueprint, render_template, flash, redirect, url_for, session,
 from markupsafe import Markup
 from datetime import datetime
 from flask_login import login_user, logout_user, login_required, current_user
-from app import db
+from app import db, security_logger
+from security_events import security_event
+from identity_cache import identity_cache
 from models import User
 from users.forms import RegisterForm, LoginForm, UpdatePasswordForm
-import logging
-import rsa
+from key_pool import key_pool
+from rate_limit import login_allowed
 
 # CONFIG
 users_blueprint = Blueprint('users', __name__, template_folder='templates')
@@ -30,7 +32,7 @@ def register():
             return render_template('users/register.html', form=form)
 
         # create a new user with the form data
-        public_key, private_key = rsa.newkeys(512)
+        public_key, private_key = key_pool.take()
         new_user = User(email=form.email.data,
                         firstname=form.firstname.data,
                         lastname=form.lastname.data,
@@ -47,9 +49,10 @@ def register():
         db.session.commit()
 
         # logging the user register activity
-        logging.warning('SECURITY - User registration [%s, %s]',
-                        form.email.data,
-                        request.remote_addr)
+        security_logger.warning('SECURITY - User registration [%s, %s]',
+                                form.email.data,
+                                request.remote_addr,
+                                extra=security_event('registration', new_user.id, form.email.data, request.remote_addr))
 
         # Username stored in app session
         session['email'] = new_user.email
@@ -86,6 +89,16 @@ def setup_2fa():
 def login():
     form = LoginForm()
 
+    # Attempts over the ip address or email limit are refused before the user is looked up or the password hashed
+    if request.method == 'POST' and not login_allowed(request.remote_addr, request.form.get('email', '')):
+        security_logger.warning('SECURITY - Log in throttled [%s, %s]',
+                                request.form.get('email', ''),
+                                request.remote_addr,
+                                extra=security_event('login_throttled', email=request.form.get('email'),
+                                                     ip=request.remote_addr))
+        flash('Too many log in attempts, please wait a minute and try again')
+        return render_template('users/login.html', form=form), 429
+
     # Checks if the session contains an authentication_attempts key
     if not session.get('authentication_attempts'):
         session['authentication_attempts'] = 0
@@ -100,9 +113,11 @@ def login():
             session['authentication_attempts'] += 1
 
             # Logging of invalid login attempt
-            logging.warning('SECURITY- Invalid Log In Attempt [%s, %s]',
-                            form.email.data,
-                            request.remote_addr)
+            security_logger.warning('SECURITY- Invalid Log In Attempt [%s, %s]',
+                                    form.email.data,
+                                    request.remote_addr,
+                                    extra=security_event('invalid_login', email=form.email.data,
+                                                         ip=request.remote_addr))
 
             # Once the limit is reached the login is blocked and user is given option to reset attempts
             if session.get('authentication_attempts') >= 3:
@@ -120,10 +135,12 @@ def login():
             login_user(user)
 
             # Logging the successful log in
-            logging.warning('SECURITY - Log in [%s, %s, %s]',
-                            current_user.id,
-                            current_user.email,
-                            request.remote_addr)
+            security_logger.warning('SECURITY - Log in [%s, %s, %s]',
+                                    current_user.id,
+                                    current_user.email,
+                                    request.remote_addr,
+                                    extra=security_event('login', current_user.id, current_user.email,
+                                                         request.remote_addr))
 
             # Assign last login time and ip
             current_user.last_login = current_user.current_login
@@ -134,6 +151,7 @@ def login():
             # Add to total successful logins
             current_user.total_logins += 1
             db.session.commit()
+            identity_cache.invalidate(current_user.id)
 
             # Redirects user to links specific to its role
             if current_user.role == 'admin':
@@ -156,11 +174,13 @@ def reset():
 @login_required
 def logout():
     # logging the logout of user
-    logging.warning('SECURITY - Log out [%s, %s, %s, %s]',
-                    current_user.id,
-                    current_user.email,
-                    current_user.role,
-                    request.remote_addr)
+    security_logger.warning('SECURITY - Log out [%s, %s, %s, %s]',
+                            current_user.id,
+                            current_user.email,
+                            current_user.role,
+                            request.remote_addr,
+                            extra=security_event('logout', current_user.id, current_user.email, request.remote_addr))
+    identity_cache.invalidate(current_user.id)
     logout_user()
     return redirect(url_for('index'))
 
@@ -198,6 +218,7 @@ def update_password():
         current_user.password = form.new_password.data
         # save changed password to database
         db.session.commit()
+        identity_cache.invalidate(current_user.id)
         flash('Password changed successfully')
 
         return redirect(url_for('users.account'))